@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : test_arq_agent.py
+@Author  : yintian
+@Date    : 2026/10/18 18:40
+@Software: PyCharm
+@Desc    : arq Agent 调度, 以及基于 fakeredis 的投放 -> 执行 -> 结果全流程
+"""
+import asyncio
+import contextlib
+import logging
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+# lua 脚本需要 lupa
+pytest.importorskip("lupa")
+
+from ytools.arq import setting  # noqa: E402
+from ytools.arq.client.agent import Agent  # noqa: E402
+from ytools.arq.client.client import Client  # noqa: E402
+
+QUEUE = "arq-test"
+logger = logging.getLogger("arq-test")
+
+
+class FakeRedis(fakeredis.FakeAsyncRedis):
+    """fakeredis 不支持 INFO, 按 7.2 处理, 以便走 ZPOPMIN / XAUTOCLAIM 分支"""
+
+    async def info(self, section=None, *args, **kwargs):
+        return {"redis_version": "7.2.0"}
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(setting, "DELAY_INTERVAL", 0.05)
+
+
+def run(coro, timeout=30):
+    return asyncio.run(asyncio.wait_for(coro, timeout))
+
+
+def make_clients(backend="zset", client_kwargs=None, **agent_kwargs):
+    redis = FakeRedis(server=fakeredis.FakeServer())
+    kwargs = dict(redis=redis, queue_name=QUEUE, backend=backend, logger=logger, heartbeat_interval=0)
+    client = Client(**kwargs, **(client_kwargs or {}))
+    agent = Agent(**kwargs, **{"handle_signals": False, "block_timeout": 0, **agent_kwargs})
+    return redis, client, agent
+
+
+@contextlib.asynccontextmanager
+async def running(*agents):
+    runners = [asyncio.create_task(agent.run()) for agent in agents]
+    try:
+        yield
+    finally:
+        await asyncio.gather(*(agent.drain(1) for agent in agents))
+        await asyncio.gather(*runners)
+
+
+async def submit(client, data, **kwargs):
+    # 先订阅结果再投放, 否则结果可能在订阅前发布
+    return await client.put(data, auto_ensure=True, **kwargs)
+
+
+def square(x, task=None):
+    return x * x
+
+
+def test_order_queues_weighted():
+    agent = Agent(queues={"a": 3, "b": 1}, heartbeat_interval=0, handle_signals=False)
+    firsts = [agent.order_queues()[0] for _ in range(8)]
+    assert firsts.count("a") == 6 and firsts.count("b") == 2
+    # 首选队列之外按权重回退
+    assert sorted(agent.order_queues()) == ["a", "b"]
+
+
+def test_order_queues_priority():
+    agent = Agent(queues={"low": 1, "high": 5}, strategy="priority", heartbeat_interval=0, handle_signals=False)
+    assert [agent.order_queues() for _ in range(3)] == [["high", "low"]] * 3
+
+
+def test_cache_only_json_roundtrip_results():
+    assert Agent.dump_cache({"a": [1, "x", None]}) == '{"a": [1, "x", null]}'
+    assert Agent.dump_cache((1, 2)) is None
+    assert Agent.dump_cache(b"x") is None
+    assert Agent.dump_cache({1: "a"}) is None
+
+
+@pytest.mark.parametrize("backend", ["zset", "stream"])
+def test_put_execute_get_result(backend):
+    async def main():
+        redis, client, agent = make_clients(backend, worker=lambda task: task.data + b"!")
+        async with running(agent):
+            tasks = [await submit(client, f"t{i}") for i in range(5)]
+            results = [await client.get_result(task, timeout=5) for task in tasks]
+        assert results == [f"t{i}!".encode() for i in range(5)]
+
+    run(main())
+
+
+def test_retry_then_success_clears_keys():
+    attempts = []
+
+    async def flaky(task):
+        attempts.append(task.task_id)
+        if len(attempts) < 2:
+            raise ConnectionError("flaky")
+        return "ok"
+
+    async def main():
+        redis, client, agent = make_clients(worker=flaky, retry={"max_attempts": 3, "backoff": 0.01, "jitter": False})
+        async with running(agent):
+            task = await submit(client, "x")
+            assert await client.get_result(task, timeout=5) == b"ok"
+            await asyncio.sleep(0.05)
+        assert len(attempts) == 2
+        assert await redis.keys(f"{QUEUE}:attempts:*") == []
+        assert await redis.keys(f"{QUEUE}:retry:*") == []
+        assert await redis.zcard(f"{QUEUE}:processing") == 0
+
+    run(main())
+
+
+def test_task_retry_policy_exhausted_moves_to_dead_letter():
+    async def fail(task):
+        raise ValueError("bad")
+
+    async def main():
+        redis, client, agent = make_clients(worker=fail)
+        async with running(agent):
+            task = await submit(client, "x", retry={"max_attempts": 2, "backoff": 0.01, "jitter": False})
+            result = await client.get_result(task, timeout=5)
+            assert result.startswith(b"ERROR::")
+            dead = await client.get_dead_tasks()
+            assert [item["task_id"] for item in dead] == [task.task_id]
+            assert dead[0]["error"] == "ValueError: bad"
+        assert await client.requeue_dead_tasks() == 1
+        assert await client.get_dead_tasks() == []
+        assert await redis.zcard(f"{QUEUE}:tasks") == 1
+
+    run(main())
+
+
+def test_failure_without_retry_policy_leaves_no_keys():
+    async def fail(task):
+        raise ValueError("bad")
+
+    async def main():
+        redis, client, agent = make_clients(worker=fail)
+        async with running(agent):
+            task = await submit(client, "x")
+            assert (await client.get_result(task, timeout=5)).startswith(b"ERROR::")
+        assert await redis.keys(f"{QUEUE}:attempts:*") == []
+        assert await client.get_dead_tasks() == []
+
+    run(main())
+
+
+def test_failed_publish_is_redelivered_after_lease():
+    async def main():
+        redis, client, agent = make_clients(lease=0.6, worker=lambda task: "ok")
+        put_result, failures = agent.put_result, [ConnectionError("publish")]
+
+        async def flaky_put_result(res, task):
+            if failures:
+                raise failures.pop()
+            return await put_result(res, task)
+
+        agent.put_result = flaky_put_result
+        async with running(agent):
+            task = await submit(client, "x")
+            assert await client.get_result(task, timeout=5) == b"ok"
+            await asyncio.sleep(0.05)
+            assert agent.leases[QUEUE] == {}
+            assert await redis.zcard(f"{QUEUE}:processing") == 0
+
+    run(main())
+
+
+@pytest.mark.parametrize("lease", [0, 300])
+def test_stream_entry_is_not_claimed_while_running(monkeypatch, lease):
+    monkeypatch.setattr(setting, "STREAM_CLAIM_IDLE", 600)
+    monkeypatch.setattr(setting, "STREAM_CLAIM_INTERVAL", 0.1)
+    runs = []
+
+    async def slow(task):
+        runs.append(task.task_id)
+        await asyncio.sleep(1.5)
+        return "done"
+
+    async def main():
+        redis, client, first = make_clients("stream", worker=slow, lease=lease, worker_id="first")
+        second = Agent(
+            worker=slow, lease=lease, worker_id="second", redis=redis, queue_name=QUEUE, backend="stream",
+            logger=logger, heartbeat_interval=0, handle_signals=False, block_timeout=0
+        )
+        async with running(first):
+            task = await submit(client, "x")
+            await asyncio.sleep(0.2)
+            async with running(second):
+                assert await client.get_result(task, timeout=5) == b"done"
+        assert len(runs) == 1
+
+    run(main())
+
+
+def test_drain_waits_for_running_task():
+    async def slow(task):
+        await asyncio.sleep(0.3)
+        return "done"
+
+    async def main():
+        redis, client, agent = make_clients(worker=slow)
+        runner = asyncio.create_task(agent.run())
+        task = await submit(client, "x")
+        await asyncio.sleep(0.1)
+        assert await agent.drain(2) is True
+        await runner
+        assert await client.get_result(task, timeout=1) == b"done"
+        assert await redis.zcard(f"{QUEUE}:tasks") == 0
+
+    run(main())
+
+
+def test_drain_requeues_unfinished_task():
+    async def stuck(task):
+        await asyncio.sleep(30)
+
+    async def main():
+        redis, client, agent = make_clients(worker=stuck, prefetch=4, max_concurrency=1)
+        runner = asyncio.create_task(agent.run())
+        for i in range(3):
+            await client.put(i)
+        await asyncio.sleep(0.2)
+        assert await agent.drain(0.2) is False
+        await runner
+        # 执行中的 1 个与本地缓冲中的任务都放回队列, 租约清除
+        assert await redis.zcard(f"{QUEUE}:tasks") == 3
+        assert await redis.zcard(f"{QUEUE}:processing") == 0
+        assert agent.leases[QUEUE] == {}
+
+    run(main())
+
+
+def test_map_with_duplicate_inputs():
+    async def main():
+        redis, client, agent = make_clients(
+            client_kwargs={"codec": "json", "dedup_func": lambda data: str(data["args"][0])},
+            codec="json"
+        )
+        async with running(agent):
+            results = [res async for res in client.map(square, [1, 2, 1, 3], ordered=True, timeout=5)]
+            assert results == [1, 4, 1, 9]
+            # 之后批次中重复的输入复用已完成任务的结果
+            results = [res async for res in client.map(square, [5, 6, 5, 5], concurrency=1, ordered=True, timeout=5)]
+            assert results == [25, 36, 25, 25]
+
+    run(main())
+
+
+def test_map_raises_when_tasks_dropped():
+    async def main():
+        redis, client, agent = make_clients(client_kwargs={"max_task_num": 2, "max_action": "break"})
+        with pytest.raises(ValueError, match="未投放"):
+            async for _ in client.map(square, range(5), timeout=5):
+                pass
+
+    run(main())
+
+
+def test_cache_hit_returns_same_object():
+    calls = []
+
+    def build(x, task=None):
+        calls.append(x)
+        return {"value": x}
+
+    async def main():
+        redis, client, agent = make_clients(cache=True)
+        payload = {"func": build, "args": [1]}
+        task = agent.make_task("t1", b"x", QUEUE)
+        miss = await agent.execute_task(task, payload)
+        hit = await agent.execute_task(task, payload)
+        assert miss == hit == {"value": 1}
+        assert calls == [1]
+        assert agent.cache_hits.value == 1
+
+    run(main())
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : test_arq_codec.py
+@Author  : yintian
+@Date    : 2026/10/18 18:20
+@Software: PyCharm
+@Desc    : arq 数据头部、编解码器白名单、压缩与外置引用
+"""
+import pickle
+
+import pytest
+
+from ytools.arq.task import blob, codec
+
+
+def test_pack_unpack_json():
+    data = {"a": [1, 2, "三"]}
+    packed = codec.pack(data, "json")
+    assert codec.is_packed(packed)
+    assert codec.unpack(packed) == data
+
+
+def test_unpack_rejects_codec_not_accepted():
+    packed = codec.pack({"a": 1}, "pickle")
+    with pytest.raises(ValueError, match="拒绝解码"):
+        codec.unpack(packed)
+    with pytest.raises(ValueError, match="拒绝解码"):
+        codec.unpack(packed, accept=["json"])
+    assert codec.unpack(packed, accept=["pickle"]) == {"a": 1}
+
+
+def test_unpack_does_not_run_pickle_payload_by_default():
+    class Boom:
+        def __reduce__(self):
+            return exec, ("raise SystemExit('pickle 被执行')",)
+
+    packed = codec.MAGIC + bytes((codec.get_codec("pickle").code, 0)) + pickle.dumps(Boom())
+    with pytest.raises(ValueError, match="拒绝解码"):
+        codec.unpack(packed)
+
+
+def test_unpack_unknown_codec():
+    with pytest.raises(ValueError, match="未知的编解码器"):
+        codec.unpack(codec.MAGIC + bytes((250, 0)) + b"x")
+
+
+def test_compress_above_threshold():
+    data = "x" * 4096
+    packed = codec.pack(data, "json", "zlib", threshold=1024)
+    assert codec.get_flags(packed) & codec.COMPRESS_MASK == codec.get_compressor("zlib").code
+    assert len(packed) < 4096
+    assert codec.unpack(packed) == data
+    small = codec.pack("x", "json", "zlib", threshold=1024)
+    assert codec.get_flags(small) & codec.COMPRESS_MASK == 0
+
+
+def test_stamp_keeps_body_and_flags():
+    packed = codec.pack({"a": 1}, "json", "zlib", flags=codec.RETRY_FLAG)
+    assert codec.get_stamp(packed) is None
+    stamped = codec.stamp(packed, 1.5)
+    assert codec.get_stamp(stamped) == 1.5
+    assert codec.get_flags(stamped) & codec.RETRY_FLAG
+    assert codec.unpack(stamped) == {"a": 1}
+    # 重新投放时覆盖而不是追加
+    restamped = codec.stamp(stamped, 2.5)
+    assert codec.get_stamp(restamped) == 2.5
+    assert len(restamped) == len(stamped)
+    assert codec.unpack(restamped) == {"a": 1}
+
+
+def test_stamp_ignores_headerless_data():
+    assert codec.stamp(b"legacy", 1.0) == b"legacy"
+    assert codec.get_stamp(b"legacy") is None
+
+
+def test_blob_ref_roundtrip():
+    ref = {"store": "redis", "key": "q:blob:1", "size": 3, "chunks": 1}
+    data = codec.stamp(blob.make_ref(ref, codec.RETRY_FLAG), 3.0)
+    assert blob.is_ref(data)
+    assert not blob.is_ref(codec.pack(ref))
+    assert blob.load_ref(data) == ref
+    assert codec.get_flags(data) & codec.RETRY_FLAG
+    with pytest.raises(ValueError):
+        codec.unpack(data)
+
+
+if __name__ == '__main__':
+    pass
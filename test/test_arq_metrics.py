@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : test_arq_metrics.py
+@Author  : yintian
+@Date    : 2026/10/18 18:30
+@Software: PyCharm
+@Desc    : arq 进程内指标
+"""
+import pytest
+
+from ytools.arq import metrics
+from ytools.arq.metrics import Histogram, Metrics, RateCounter
+
+
+def test_histogram_quantile():
+    histogram = Histogram([1, 2, 4])
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(6.5)
+    # 第 2 个值落在 (1, 2] 桶中, 桶内有 2 个, 线性插值到中点
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    assert histogram.quantile(1) == pytest.approx(4)
+    histogram.observe(10)
+    # 超出最大上界时返回最大上界
+    assert histogram.quantile(1) == 4
+
+
+def test_histogram_merge():
+    a, b = Histogram([1, 2]), Histogram([1, 2])
+    a.observe(0.5)
+    b.observe(1.5)
+    b.observe(5)
+    merged = Histogram.from_dict(a.to_dict(), [1, 2])
+    merged.merge(b.to_dict())
+    assert merged.counts == [1, 1, 1]
+    assert merged.count == 3
+
+
+def test_rate_counter_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metrics.time, "monotonic", lambda: now[0])
+    counter = RateCounter(window=3)
+    counter.increment()
+    counter.increment(2)
+    now[0] += 1
+    counter.increment()
+    assert counter.count() == 4
+    now[0] += 2
+    # 第一个桶已过期
+    assert counter.count() == 1
+    counter.increment()
+    assert counter.count() == 2
+    now[0] += 10
+    assert counter.count() == 0
+
+
+def test_metrics_merge_and_render():
+    a, b = Metrics([1]), Metrics([1])
+    a.observe("q", "exec_time", 0.5)
+    a.increment("q", "failures")
+    b.observe("q", "exec_time", 2)
+    b.increment("q", "failures", 2)
+    merged = Metrics([1])
+    merged.merge(a.to_dict())
+    merged.merge(b.to_dict())
+    assert merged.counters["q"]["failures"] == 3
+    assert merged.histograms["q"]["exec_time"].counts == [1, 1]
+    text = merged.render()
+    assert 'arq_exec_time_seconds_bucket{queue="q",le="+Inf"} 2' in text
+    assert 'arq_failures_total{queue="q"} 3' in text
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : test_arq_retry.py
+@Author  : yintian
+@Date    : 2026/10/18 18:25
+@Software: PyCharm
+@Desc    : arq 重试策略
+"""
+import pytest
+
+from ytools.arq.retry import RetryPolicy
+
+
+def test_should_retry_until_max_attempts():
+    policy = RetryPolicy(max_attempts=3)
+    assert policy.should_retry(1, ValueError())
+    assert policy.should_retry(2, ValueError())
+    assert not policy.should_retry(3, ValueError())
+
+
+def test_should_retry_only_listed_exceptions():
+    policy = RetryPolicy(max_attempts=5, retry_on=(ConnectionError, "TimeoutError", "builtins.KeyError"))
+    assert policy.should_retry(1, ConnectionResetError())
+    assert policy.should_retry(1, TimeoutError())
+    assert policy.should_retry(1, KeyError())
+    assert not policy.should_retry(1, ValueError())
+
+
+def test_countdown_exponential_and_capped():
+    policy = RetryPolicy(backoff=1, factor=2, max_backoff=5, jitter=False)
+    assert [policy.countdown(n) for n in range(1, 6)] == [1, 2, 4, 5, 5]
+
+
+def test_countdown_jitter_in_range():
+    policy = RetryPolicy(backoff=4, factor=2, jitter=True)
+    for _ in range(100):
+        assert 4 <= policy.countdown(2) <= 8
+
+
+@pytest.mark.parametrize("policy", [None, 3, {"max_attempts": 3, "backoff": 0.5}, RetryPolicy(max_attempts=3)])
+def test_make(policy):
+    made = RetryPolicy.make(policy)
+    if policy is None:
+        assert made is None
+    else:
+        assert made.max_attempts == 3
+
+
+def test_to_dict_roundtrip():
+    policy = RetryPolicy(max_attempts=4, backoff=0.5, retry_on=(ConnectionError, "KeyError"))
+    made = RetryPolicy.make(policy.to_dict())
+    assert made.to_dict() == policy.to_dict()
+    assert made.should_retry(1, ConnectionError())
+    assert made.should_retry(1, KeyError())
+    assert not made.should_retry(1, ValueError())
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : __main__.py
+@Author  : yintian
+@Date    : 2026/10/18 15:10
+@Software: PyCharm
+@Desc    : arq 命令行工具
+
+python -m ytools.arq stats <queue> --redis redis://127.0.0.1:6379/0
+"""
+import argparse
+import asyncio
+import json
+import unicodedata
+
+from ytools.arq.client.base import BaseClient
+from ytools.arq.metrics import Metrics, Histogram
+
+
+def latency(info: dict, q: float):
+    """合并该实例各队列的执行耗时直方图后估算分位数"""
+    histogram = Histogram()
+    for queue in Metrics.from_dicts([info.get("metrics")]).histograms.values():
+        if "exec_time" in queue:
+            histogram.merge(queue["exec_time"].to_dict())
+    return histogram.quantile(q)
+
+
+def fmt(value, digits=3):
+    if value is None:
+        return "-"
+    return f"{value:.{digits}f}" if isinstance(value, float) else str(value)
+
+
+def width(text: str) -> int:
+    """终端显示宽度, 中文占两列"""
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+
+def render(stats: dict) -> str:
+    lines = [
+        f"队列 {stats['queue']} ({stats['backend']})",
+        f"  就绪 {stats['ready']}  延迟 {stats['delayed']}  执行中 {stats['in_flight']}  死信 {stats['dead']}",
+        "",
+    ]
+    header = ("角色", "worker_id", "执行中/并发", "总任务", "吞吐(/s)", "p50(s)", "p99(s)")
+    rows = []
+    for info in sorted(stats["workers"], key=lambda item: (item["role"], str(item.get("worker_id")))):
+        if info["role"] == "client":
+            rows.append((info["role"], str(info.get("worker_id")), "-", fmt(info.get("task_count")), "-", "-", "-"))
+            continue
+        rows.append((
+            info["role"],
+            str(info.get("worker_id")),
+            f"{info.get('running', 0)}/{info.get('concurrency') or '-'}",
+            fmt(info.get("success_tasks")),
+            fmt(info.get("tasks_last_minute", 0) / 60, 2),
+            fmt(latency(info, 0.5)),
+            fmt(latency(info, 0.99)),
+        ))
+    if not rows:
+        lines.append("  没有存活的实例")
+        return "\n".join(lines)
+    widths = [max(width(row[i]) for row in [header, *rows]) for i in range(len(header))]
+    for row in [header, *rows]:
+        lines.append("  " + "  ".join(cell + " " * (size - width(cell)) for cell, size in zip(row, widths)).rstrip())
+    return "\n".join(lines)
+
+
+async def stats(args):
+    client = BaseClient(queue_name=args.queue, redis=args.redis, backend=args.backend, heartbeat_interval=0)
+    try:
+        if not args.backend and await client.redis.exists(client.stream_queue):
+            client.backend = "stream"
+        result = await client.get_stats()
+    finally:
+        await client.redis.aclose()
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else render(result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ytools.arq", description="arq 命令行工具")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_stats = commands.add_parser("stats", help="查看队列与各实例状态")
+    parser_stats.add_argument("queue", help="队列名")
+    parser_stats.add_argument("-r", "--redis", default="redis://127.0.0.1:6379/0", help="redis 连接地址")
+    parser_stats.add_argument("--backend", default=None, choices=["zset", "stream"], help="默认根据 stream key 是否存在判断")
+    parser_stats.add_argument("--json", action="store_true", help="输出 json")
+    args = parser.parse_args(argv)
+    if args.command == "stats":
+        asyncio.run(stats(args))
+
+
+if __name__ == '__main__':
+    main()
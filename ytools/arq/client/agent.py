@@ -8,48 +8,281 @@
 """
 import asyncio
 import contextlib
+import hashlib
 import inspect
+import json
+import math
+import multiprocessing
+import os
+import signal
+import time
+import weakref
 from asyncio import Event
-from typing import Callable, Any
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Callable, Any, Literal
 
-from ytools.arq import setting
+from redis.exceptions import ResponseError
+
+from ytools.arq import setting, scripts
+from ytools.arq.client import process
 from ytools.arq.client.base import BaseClient
+from ytools.arq.limiter import RateLimiter
+from ytools.arq.metrics import Metrics, RateCounter
+from ytools.arq.retry import RetryPolicy
+from ytools.arq.task import blob, codec
 from ytools.arq.task.task import Task
 from ytools.utils import magic
 from ytools.utils.counter import FastWriteCounter
+from ytools.utils.package import parse
+
+# ZPOPMIN / BZPOPMIN 自 redis 5.0 起可用
+ZPOP_VERSION = parse("5.0.0")
+# XAUTOCLAIM 自 redis 6.2 起可用
+XAUTOCLAIM_VERSION = parse("6.2.0")
 
 
 class Agent(BaseClient):
-    def __init__(self, worker: Callable[[Task], Any] | None = None, max_concurrency=None, **kwargs):
+    # 当前进程中正在运行的 Agent, 收到退出信号时一并平滑停止
+    instances: "weakref.WeakSet[Agent]" = weakref.WeakSet()
+    stopping: asyncio.Task | None = None
+
+    def __init__(
+            self,
+            worker: Callable[[Task], Any] | None = None,
+            max_concurrency=None,
+            block_timeout: float = None,
+            prefetch: int = None,
+            atomic: bool = True,
+            executor: Literal["thread", "process"] = "thread",
+            processes: int = None,
+            warmup: list[str | Callable] = None,
+            queues: dict[str, float] | list[str] = None,
+            strategy: Literal["weighted", "priority"] = "weighted",
+            retry: RetryPolicy | dict | int | None = None,
+            lease: float = None,
+            cache: bool | float = False,
+            timeout: float = None,
+            metrics_port: int = None,
+            rate_limit: float | dict = None,
+            drain_timeout: float = None,
+            handle_signals: bool | tuple[int, ...] = True,
+            **kwargs
+    ):
+        if queues and not kwargs.get("queue_name"):
+            kwargs["queue_name"] = next(iter(queues))
         super().__init__(**kwargs)
         self.worker = worker or self.run_task
+        # 阻塞出队超时时间, 为 0 时使用轮询
+        self.block_timeout = setting.BLOCK_TIMEOUT if block_timeout is None else block_timeout
+        self.blocking = False
+        # 本地预取缓冲, 默认大小与 max_concurrency 一致, 低于低水位时补充
+        self.prefetch = prefetch or max_concurrency or 1
+        self.low_water = self.prefetch // 2
+        self.buffer: deque[Task] = deque()
+        # 消费的队列及权重, weighted 按权重比例拉取, priority 按权重严格优先
+        if isinstance(queues, dict):
+            self.queues = dict(queues)
+        else:
+            self.queues = dict.fromkeys(queues or [self.queue_name], 1)
+        self.strategy = strategy
+        self.queue_order = sorted(self.queues, key=self.queues.get, reverse=True)
+        self.current_weights = dict.fromkeys(self.queues, 0)
+        # 重试策略, 可为 {队列名: 策略} 分别指定; 任务投放时自带的策略优先
+        if isinstance(retry, dict) and retry and set(retry) <= set(self.queues):
+            self.retry_policies = {queue_name: RetryPolicy.make(policy) for queue_name, policy in retry.items()}
+        else:
+            self.retry_policies = dict.fromkeys(self.queues, RetryPolicy.make(retry))
+        # 使用 lua 脚本原子出队, 出队的同时读取并删除任务数据
+        self.atomic = atomic
+        # 全局限速: 每秒次数或 {"rate", "capacity", "batch", "key"}, 也可为 {队列名: 限速} 分别指定; 执行任务前先取得令牌
+        self.limiters: dict[str, RateLimiter] = {}
+        if rate_limit is not None:
+            if isinstance(rate_limit, dict) and "rate" not in rate_limit:
+                limits = rate_limit
+            else:
+                limits = dict.fromkeys(self.queues, rate_limit)
+            shared: dict[str, RateLimiter] = {}
+            for queue_name, limit in limits.items():
+                limiter = RateLimiter.make(self, queue_name, limit)
+                # 同一个限速 key 共用本地令牌
+                self.limiters[queue_name] = shared.setdefault(limiter.key, limiter)
+        # 任务租约: 出队时写入 <queue>:processing, 执行期间定期续约, 完成后清除; 过期的租约会被重新投放
+        # stream 后端由消费组的待确认列表充当租约, 续约即重置条目的空闲时间
+        self.lease = setting.LEASE_TIME if lease is None else lease
+        # stream 后端的条目空闲超过 STREAM_CLAIM_IDLE 即可被其他消费者认领, 不开启租约时也要续约
+        self.keep_lease = bool(self.lease) or self.backend == "stream"
+        self.leases: dict[str, dict[str, Task]] = {queue_name: {} for queue_name in self.queues}
+        self.keeper: asyncio.Task | None = None
+        # stream 后端的消费者名称与认领进度
+        self.consumer = self.worker_id or f"{self.get_host_ip()}:{os.getpid()}"
+        self.claim_start: dict[str, str] = {}
+        self.last_claim = 0.0
+        # 进程池执行模式: 同步函数在子进程中运行, 传入解码后的数据而不是 Task
+        self.pool: ProcessPoolExecutor | None = None
+        if executor == "process":
+            self.pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context(setting.PROCESS_START_METHOD),
+                initializer=process.warmup,
+                initargs=(warmup,)
+            )
+        # 结果缓存: {"func": ...} 任务按 func/args/kwargs 缓存结果, True 使用默认有效期, 传入数字则作为有效期秒数
+        self.cache_ttl = setting.CACHE_TTL if cache is True else (cache or 0)
+        # 单个任务的执行超时(秒), 同步函数超时后线程/子进程中的调用不会被中断
+        self.timeout = timeout
+        # 按队列统计的耗时直方图与计数器, 随心跳上报; 设置 metrics_port 时在本地端口输出 prometheus 文本
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        # 最近一分钟完成的任务数
+        self.recent_tasks = RateCounter()
         self.success_tasks = FastWriteCounter()
+        self.retry_tasks = FastWriteCounter()
+        self.dead_tasks = FastWriteCounter()
+        self.cache_hits = FastWriteCounter()
+        self.cache_misses = FastWriteCounter()
         self.extra = {
             "success_tasks": self.success_tasks.value,
+            "retry_tasks": self.retry_tasks.value,
+            "dead_tasks": self.dead_tasks.value,
+            "cache_hits": self.cache_hits.value,
+            "cache_misses": self.cache_misses.value,
+        }
+        # 执行槽位: 先拿到空闲槽位再拉取任务, 积压留在 redis 中由其他 Agent 消费
+        self.max_concurrency = max_concurrency
+        self.slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.running: dict[asyncio.Task, Task] = {}
+        self.mover: asyncio.Task | None = None
+        self.metrics_server: asyncio.AbstractServer | None = None
+        # 平滑停止: drain 后不再拉取新任务; idle 表示拉取循环未在运行
+        self.drain_timeout = setting.DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        self.draining: asyncio.Task | None = None
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # 收到这些信号时平滑停止, True 为 SIGTERM 与 SIGINT
+        self.handle_signals = (signal.SIGTERM, signal.SIGINT) if handle_signals is True else tuple(handle_signals or ())
+
+    @property
+    def info(self):
+        return {
+            **super().info,
+            "concurrency": self.max_concurrency or 0,
+            "running": len(self.running),
+            "tasks_last_minute": self.recent_tasks.count(),
+            "metrics": self.metrics.to_dict(),
         }
-        if max_concurrency:
-            self.context = asyncio.Semaphore(max_concurrency)
-        else:
-            self.context = contextlib.nullcontext()
 
     async def do(self, task):
-        async with self.context:
-            try:
-                res = await self.run_callable(self.worker, task)
-            except Exception as e:
-                self.log(f"执行任务失败 task_id={task.task_id}: {type(e).__name__}: {e}", level="error")
-                res = f"ERROR::{type(e)}|{str(e)}"
-            await self.put_result(res, task)
-            self.success_tasks.increment()
-            self.extra["success_tasks"] = self.success_tasks.value
-            if task.callback:
-                asyncio.create_task(self.callback(task, res))
+        try:
+            await self.handle(task)
+        except asyncio.CancelledError:
+            # 平滑停止时取消的任务由 drain 放回队列并清除租约
+            raise
+        except BaseException as e:
+            # 限速、发布结果、重试或确认时出错: 只丢弃本地租约不再续约, 由租约过期后的回收重新投放, 不清除 processing
+            queue_name = task.queue_name or self.queue_name
+            self.leases.get(queue_name, {}).pop(task.task_id, None)
+            tail = "租约过期后重新投放" if self.keep_lease else "未开启租约, 任务丢失"
+            self.log(f"处理任务异常 task_id={task.task_id}: {type(e).__name__}: {e}, {tail}", level="error")
+
+    async def handle(self, task):
+        queue_name = task.queue_name or self.queue_name
+        if task.enqueued_at:
+            self.metrics.observe(queue_name, "queue_wait", max(time.time() - task.enqueued_at, 0))
+        if limiter := self.limiters.get(queue_name):
+            await limiter.acquire()
+        try:
+            # 外置存储的任务数据在开始执行时才读取, task.raw 仍为引用, 重新投放时无需再次写入
+            task.data = await self.resolve(task.data)
+            res = await self.run_worker(task)
+        except Exception as e:
+            self.log(f"执行任务失败 task_id={task.task_id}: {type(e).__name__}: {e}", level="error")
+            self.metrics.increment(queue_name, "failures")
+            isinstance(e, asyncio.TimeoutError) and self.metrics.increment(queue_name, "timeouts")
+            if await self.retry_task(task, e):
+                await self.ack(task)
+                return
+            res = f"ERROR::{type(e)}|{str(e)}"
+        start = time.monotonic()
+        await self.put_result(res, task)
+        self.metrics.observe(queue_name, "publish_time", time.monotonic() - start)
+        await self.ack(task)
+        self.success_tasks.increment()
+        self.extra["success_tasks"] = self.success_tasks.value
+        self.recent_tasks.increment()
+        if task.callback:
+            asyncio.create_task(self.callback(task, res))
+
+    async def retry_task(self, task: Task, exc: Exception) -> bool:
+        """
+        任务失败后按重试策略处理, 可重试时经延迟队列退避后重新投放, 重试耗尽时移入死信队列
+
+        :return: 是否已重新投放
+        """
+        queue_name = task.queue_name or self.queue_name
+        policy = self.retry_policies.get(queue_name)
+        # 既没有队列策略、投放时也未附带策略的任务不重试, 也不记录失败次数
+        if not policy and not task.has_retry():
+            return False
+        attempts_queue = self.get_queue("attempts", task.task_id, base=queue_name)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            task.has_retry() and await pipe.get(self.get_queue("retry", task.task_id, base=queue_name))
+            await pipe.incr(attempts_queue)
+            await pipe.expire(attempts_queue, setting.RETRY_EXPIRE)
+            *own, attempts, _ = await pipe.execute()
+        if own and own[0]:
+            policy = RetryPolicy.make(json.loads(own[0]))
+        if not policy:
+            return False
+        if not policy.should_retry(attempts, exc):
+            await self.dead_letter(task, exc)
+            return False
+        countdown = policy.countdown(attempts)
+        task.eta = time.time() + countdown
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await self.release(pipe, task)
+            await self.enqueue(pipe, [task])
+            await pipe.execute()
+        self.retry_tasks.increment()
+        self.extra["retry_tasks"] = self.retry_tasks.value
+        self.metrics.increment(queue_name, "retries")
+        self.log(f"任务 task_id={task.task_id} 第 {attempts} 次失败, {countdown:.2f}s 后重试", level="warning")
+        return True
+
+    async def dead_letter(self, task: Task, exc: Exception):
+        """重试耗尽的任务移入死信队列, 保留原始数据与最后一次报错"""
+        queue_name = task.queue_name or self.queue_name
+        data = task.raw if task.raw is not None else task.encode_data()
+        if blob.is_ref(data) and isinstance(task.data, bytes) and not blob.is_ref(task.data):
+            # 外置数据会在发布结果后删除, 死信中保存已读取的完整数据
+            data = task.data
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.zadd(self.get_queue("dead", base=queue_name), {task.task_id: time.time()})
+            await pipe.hset(self.get_queue("dead", "data", base=queue_name), task.task_id, data)
+            await pipe.hset(self.get_queue("dead", "error", base=queue_name), task.task_id, f"{type(exc).__name__}: {exc}")
+            await pipe.delete(self.get_queue("attempts", task.task_id, base=queue_name))
+            await pipe.execute()
+        self.dead_tasks.increment()
+        self.extra["dead_tasks"] = self.dead_tasks.value
+        self.log(f"任务 task_id={task.task_id} 重试耗尽, 移入死信队列", level="error")
+
+    async def run_worker(self, task: Task):
+        start = time.monotonic()
+        try:
+            if self.timeout:
+                return await asyncio.wait_for(self.run_callable(self.worker, task), self.timeout)
+            return await self.run_callable(self.worker, task)
+        finally:
+            self.metrics.observe(task.queue_name or self.queue_name, "exec_time", time.monotonic() - start)
 
     @staticmethod
     def is_async_callable(func):
         return inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(getattr(func, "__call__", None))
 
     async def run_callable(self, func, *args, **kwargs):
+        if self.pool and not self.is_async_callable(func):
+            return await self.run_in_process(func, *args, **kwargs)
         pre = magic.prepare(func, *args, **kwargs)
         if self.is_async_callable(pre.func):
             return await pre()
@@ -58,11 +291,23 @@ class Agent(BaseClient):
             return await res
         return res
 
-    async def run_task(self, task: Task):
+    async def run_in_process(self, func, *args, **kwargs):
+        # Task 持有 redis 连接无法序列化, 子进程中收到的是解码后的数据
+        args = [self.get_payload(arg) if isinstance(arg, Task) else arg for arg in args]
+        kwargs = {k: self.get_payload(v) if isinstance(v, Task) else v for k, v in kwargs.items()}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, process.call, func, args, kwargs)
+
+    @staticmethod
+    def get_payload(task: Task):
         payload = task.data
         if isinstance(payload, (str, bytes)):
             with contextlib.suppress(Exception):
                 payload = task.decode_data()
+        return payload
+
+    async def run_task(self, task: Task):
+        payload = self.get_payload(task)
         self.log(f"收到任务 task_id={task.task_id}: {payload}")
         result = await self.execute_task(task, payload)
         self.log(f"任务结果 task_id={task.task_id}: {result}")
@@ -91,7 +336,36 @@ class Agent(BaseClient):
         if normalized is None:
             return payload
         func, args, kwargs = normalized
-        return await self.run_callable(func, *args, **kwargs, task=task)
+        if not self.cache_ttl:
+            return await self.run_callable(func, *args, **kwargs, task=task)
+        cache_queue = self.get_queue("cache", self.cache_key(payload["func"], args, kwargs), base=task.queue_name or self.queue_name)
+        if (cached := await self.redis.get(cache_queue)) is not None:
+            self.cache_hits.increment()
+            self.extra["cache_hits"] = self.cache_hits.value
+            return json.loads(cached)
+        self.cache_misses.increment()
+        self.extra["cache_misses"] = self.cache_misses.value
+        result = await self.run_callable(func, *args, **kwargs, task=task)
+        if (dumped := self.dump_cache(result)) is not None:
+            await self.redis.set(cache_queue, dumped, ex=int(self.cache_ttl))
+        return result
+
+    @staticmethod
+    def dump_cache(result) -> str | None:
+        """只缓存可由 json 原样还原的结果, 命中时返回与执行得到的结果相同的对象, 经同样的编码发布"""
+        try:
+            dumped = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None
+        return dumped if json.loads(dumped) == result else None
+
+    @staticmethod
+    def cache_key(func, args, kwargs) -> str:
+        """func/args/kwargs 的稳定哈希, kwargs 顺序不影响结果"""
+        if not isinstance(func, str):
+            func = f"{func.__module__}:{func.__qualname__}"
+        key = json.dumps([func, list(args), kwargs], sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=repr)
+        return hashlib.sha256(key.encode(setting.DEFAULT_ENCODING)).hexdigest()
 
     async def callback(self, task: Task, res):
         try:
@@ -105,55 +379,434 @@ class Agent(BaseClient):
             self.log(f"执行 callback 报错: {e}", level="error")
 
     async def run(self, event: Event = None):
-        while True:
-            try:
+        self.blocking = bool(self.block_timeout) and await self.get_redis_version() >= ZPOP_VERSION
+        if self.backend == "stream":
+            for queue_name in self.queues:
+                await self.create_group(queue_name)
+        self.mover = asyncio.create_task(self.promote_loop())
+        if self.keep_lease:
+            self.keeper = asyncio.create_task(self.lease_loop())
+        if self.metrics_port:
+            self.metrics_server = await self.metrics.serve(self.metrics_port)
+            self.log(f"指标地址: http://127.0.0.1:{self.metrics_port}/metrics")
+        self.install_signal_handlers(self.handle_signals)
+        Agent.instances.add(self)
+        self.idle.clear()
+        try:
+            while not self.draining:
                 if event and event.is_set():
                     await asyncio.sleep(setting.INTERVAL)
                     continue
+                self.slots and await self.slots.acquire()
+                if self.draining:
+                    self.slots and self.slots.release()
+                    break
                 task: Task = await self.get_task()
                 if not task:
+                    self.slots and self.slots.release()
+                    # 阻塞模式下 get_task 已经等待过, 无需再休眠
+                    self.blocking or await asyncio.sleep(setting.INTERVAL)
                     continue
+                if self.draining:
+                    # 开始停止时刚取到的任务不再执行, 随本地缓冲一起放回队列
+                    self.buffer.appendleft(task)
+                    self.slots and self.slots.release()
+                    break
                 self.task_count.increment()
-                asyncio.create_task(self.do(task))
-            finally:
-                await asyncio.sleep(setting.INTERVAL)
+                self.start(task)
+        finally:
+            self.idle.set()
+        await asyncio.shield(self.draining)
+
+    async def drain(self, timeout: float = None) -> bool:
+        """
+        平滑停止: 不再拉取新任务, 等待执行中的任务完成并发布结果; 超时未完成的任务与本地缓冲中的任务放回队列并清除租约,
+        然后停止后台任务、删除心跳, run 随之返回. 重复调用等待同一次停止完成
+
+        :param timeout: 等待执行中任务的最长时间(秒), 默认 drain_timeout
+        :return: 执行中的任务是否都在超时前完成
+        """
+        if self.draining is None:
+            self.draining = asyncio.create_task(self.shutdown(self.drain_timeout if timeout is None else timeout))
+        return await asyncio.shield(self.draining)
+
+    async def shutdown(self, timeout: float) -> bool:
+        self.log(f"开始平滑停止, 执行中 {len(self.running)} 个, 本地缓冲 {len(self.buffer)} 个", level="warning")
+        deadline = time.monotonic() + timeout
+        # 拉取循环可能在等待执行槽位或阻塞出队(至多 block_timeout 秒), 直接取消会丢失已出队的任务, 等它自行退出
+        stopped = asyncio.ensure_future(self.idle.wait())
+        while self.running or not stopped.done():
+            if (remaining := deadline - time.monotonic()) <= 0:
+                break
+            await asyncio.wait([stopped, *self.running], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        unfinished = list(self.running.values())
+        if unfinished:
+            self.log(f"等待 {timeout}s 后仍有 {len(unfinished)} 个任务未完成, 取消并放回队列", level="warning")
+            futures = list(self.running)
+            for future in futures:
+                future.cancel()
+            await asyncio.wait(futures, timeout=1)
+        # 取消执行中的任务后槽位已释放, 拉取循环随即退出
+        await stopped
+        tasks = [*unfinished, *self.buffer]
+        self.buffer.clear()
+        try:
+            tasks and await self.requeue(tasks)
+        except Exception as e:
+            self.log(f"放回任务失败, 将在租约过期后被回收: {type(e).__name__}: {e}", level="error")
+        for background in (self.mover, self.keeper):
+            background and background.cancel()
+        self.metrics_server and self.metrics_server.close()
+        self.pool and await asyncio.to_thread(self.pool.shutdown, cancel_futures=True)
+        await self.deregister()
+        Agent.instances.discard(self)
+        self.log(f"已停止, 放回队列 {len(tasks)} 个任务", level="warning")
+        return not unfinished
+
+    async def requeue(self, tasks: list[Task]):
+        """把未执行完的任务原样放回就绪队列并清除租约, stream 后端重新写入后确认原条目"""
+        for task in tasks:
+            task.eta = None
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for task in tasks:
+                await self.release(pipe, task)
+            await self.enqueue(pipe, tasks)
+            await pipe.execute()
+        for task in tasks:
+            await self.ack(task)
+
+    @classmethod
+    def install_signal_handlers(cls, signals: tuple[int, ...]):
+        """
+        收到退出信号时平滑停止本进程中所有 Agent, 完成后执行 ytools.utils.quiter 中登记的退出函数;
+        停止期间再次收到信号则按 quiter 的方式立即退出
+        """
+        if not signals:
+            return
+        loop = asyncio.get_running_loop()
+        for signum in signals:
+            # 非主线程或不支持的平台沿用原有处理
+            with contextlib.suppress(NotImplementedError, RuntimeError, ValueError):
+                loop.add_signal_handler(signum, cls.on_signal, signum)
+
+    @classmethod
+    def on_signal(cls, signum):
+        # quiter 导入时会注册自身的信号处理, 在此处才导入
+        from ytools.utils.quiter import Quiter
+        if cls.stopping and not cls.stopping.done():
+            Quiter.run(signum, None)
+        cls.stopping = asyncio.create_task(cls.drain_all())
+
+    @classmethod
+    async def drain_all(cls, timeout: float = None):
+        """平滑停止本进程中所有正在运行的 Agent, 然后执行 quiter 中登记的退出函数"""
+        from ytools.utils.quiter import Quiter
+        await asyncio.gather(*(agent.drain(timeout) for agent in list(cls.instances)), return_exceptions=True)
+        Quiter.run_ev()
+
+    async def promote_loop(self):
+        """定时把各队列已到期的延迟任务移入就绪队列, 只处理到期部分"""
+        while True:
+            try:
+                for queue_name in self.queues:
+                    while await self.promote(queue_name) >= setting.DELAY_BATCH:
+                        pass
+            except Exception as e:
+                self.log(f"移动延迟任务失败: {type(e).__name__}: {e}", level="error")
+            await asyncio.sleep(setting.DELAY_INTERVAL)
+
+    async def lease_loop(self):
+        """每隔 renew_interval 为持有的任务续约一次, 并回收其他 Agent 已过期的租约"""
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                await self.renew()
+                if self.backend == "stream":
+                    continue
+                for queue_name in self.queues:
+                    if count := await self.reap(queue_name):
+                        self.log(f"回收过期租约, 重新投放任务 {count} 个, queue={queue_name}", level="warning")
+            except Exception as e:
+                self.log(f"续约/回收租约失败: {type(e).__name__}: {e}", level="error")
+
+    async def renew(self):
+        """为本地缓冲及执行中的任务续约"""
+        leases = [(queue_name, list(tasks.values())) for queue_name, tasks in self.leases.items() if tasks]
+        if not leases:
+            return
+        deadline = time.time() + self.lease
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for queue_name, tasks in leases:
+                if self.backend == "stream":
+                    entry_ids = [task.entry_id for task in tasks if getattr(task, "entry_id", None)]
+                    entry_ids and await pipe.xclaim(
+                        self.get_queue("stream", base=queue_name),
+                        setting.STREAM_GROUP,
+                        self.consumer,
+                        0,
+                        entry_ids,
+                        justid=True
+                    )
+                    continue
+                await pipe.zadd(self.get_queue("processing", base=queue_name), {task.task_id: deadline for task in tasks}, xx=True)
+                for task in tasks:
+                    await pipe.expire(self.get_queue("data", task.task_id, base=queue_name), self.lease_expire)
+            await pipe.execute()
+
+    async def release(self, pipe, task: Task):
+        """清除任务租约, 与发布结果或重新投放在同一个 pipeline 中执行"""
+        queue_name = task.queue_name or self.queue_name
+        if self.leases.get(queue_name, {}).pop(task.task_id, None) is None or self.backend == "stream":
+            return
+        await pipe.zrem(self.get_queue("processing", base=queue_name), task.task_id)
+        await pipe.delete(self.get_queue("data", task.task_id, base=queue_name))
+
+    @property
+    def renew_interval(self) -> float:
+        """续约间隔, 为租约时长的 1/3; stream 后端同时不超过 STREAM_CLAIM_IDLE 的 1/3, 执行中的条目不会被其他消费者认领"""
+        lease = self.lease or math.inf
+        if self.backend == "stream":
+            lease = min(lease, setting.STREAM_CLAIM_IDLE / 1000)
+        return lease / 3
+
+    @property
+    def lease_expire(self) -> int:
+        """持有租约期间任务数据的过期时间, 保证租约过期后仍能重新投放"""
+        return setting.EXPIRE_TIME + math.ceil(self.lease)
+
+    def start(self, task: Task):
+        future = asyncio.create_task(self.do(task))
+        self.running[future] = task
+        future.add_done_callback(self.finish)
+
+    def finish(self, future: asyncio.Task):
+        self.running.pop(future, None)
+        self.slots and self.slots.release()
 
     async def get_task(self):
-        task_id = await self.zpop(self.tasks_queue)
-        if not task_id:
-            return None
-        data = await self.redis.get(self.get_queue(task_id, base=self.data_queue))
+        if len(self.buffer) <= self.low_water:
+            await self.fill_buffer()
+        return self.buffer.popleft() if self.buffer else None
+
+    async def fill_buffer(self):
+        """预取任务至本地缓冲, 按调度顺序依次尝试各队列, 缓冲中仍有任务时不阻塞等待"""
+        count = self.prefetch - len(self.buffer)
+        queue_names = self.order_queues()
+        if self.backend == "stream":
+            tasks = await self.read_streams(queue_names, count=count, block=not self.buffer)
+        else:
+            tasks = []
+            for queue_name in queue_names:
+                if tasks := await self.pop_tasks(queue_name, count=count):
+                    break
+            if not tasks and not self.buffer and self.blocking:
+                tasks = await self.bpop_tasks(queue_names, count=count)
+        self.buffer.extend(tasks)
+
+    def order_queues(self) -> list[str]:
+        """
+        本次拉取的队列顺序
+
+        priority: 固定按权重从高到低
+        weighted: 平滑加权轮询选出首选队列, 首选队列为空时按权重依次回退到其他队列
+        """
+        if self.strategy == "priority" or len(self.queues) == 1:
+            return self.queue_order
+        total, best = 0, None
+        for queue_name, weight in self.queues.items():
+            self.current_weights[queue_name] += weight
+            total += weight
+            if best is None or self.current_weights[queue_name] > self.current_weights[best]:
+                best = queue_name
+        self.current_weights[best] -= total
+        return [best, *[queue_name for queue_name in self.queue_order if queue_name != best]]
+
+    def make_task(self, task_id, data, queue_name=None, enqueued_at=None):
+        """:param enqueued_at: 投放时间戳, 未传入时从数据头部读取"""
+        if isinstance(task_id, bytes):
+            task_id = task_id.decode()
         if data is None:
             self.log(f"task_id:{task_id} 未获取到数据", level="error")
             return None
-        return Task(
+        queue_name = queue_name or self.queue_name
+        task = Task(
             data=data,
             client=self,
             task_id=task_id,
-            fmt=True
+            result_queue=self.get_queue(task_id, base=self.get_queue("result", base=queue_name)),
+            fmt=True,
+            queue_name=queue_name,
+            raw=data,
+            enqueued_at=enqueued_at or codec.get_stamp(data),
         )
+        if self.keep_lease:
+            self.leases.setdefault(queue_name, {})[task_id] = task
+        return task
 
-    async def zpop(self, key: str):
-        result = None
-        if (await self.redis.info("server")).get("redis_version", "0.0.0") >= "5.0.0":
-            result = await self.redis.zpopmin(self.tasks_queue, count=1)
-            result = result and result[0]
+    async def load_tasks(self, task_ids: list[str], queue_name=None) -> list[Task]:
+        if not task_ids:
+            return []
+        data_queue = self.get_queue("data", base=queue_name or self.queue_name)
+        data = await self.redis.mget([self.get_queue(task_id, base=data_queue) for task_id in task_ids])
+        tasks = map(self.make_task, task_ids, data, repeat(queue_name))
+        return [task for task in tasks if task]
+
+    async def pop_tasks(self, queue_name: str, count=1, *task_ids: str) -> list[Task]:
+        """
+        从队列中出队至多 count 个任务
+
+        atomic 模式下一次 EVALSHA 完成弹出任务 id、读取数据、写入租约(未开启租约时删除数据)
+
+        :param queue_name: 队列名
+        :param count: 出队数量
+        :param task_ids: 已出队(如 BZPOPMIN)但还未读取数据的任务 id
+        """
+        tasks_queue = self.get_queue("tasks", base=queue_name)
+        processing_queue = self.get_queue("processing", base=queue_name)
+        deadline = time.time() + self.lease if self.lease else 0
+        if not self.atomic:
+            task_ids = [*task_ids, *await self.zpop(tasks_queue, count=count)]
+            task_ids and deadline and await self.redis.zadd(processing_queue, dict.fromkeys(task_ids, deadline))
+            return await self.load_tasks(task_ids, queue_name)
+        script = self.get_script(scripts.POP_TASKS)
+        prefix = self.get_queue("data", "", base=queue_name)
+        result = await script(keys=[tasks_queue, processing_queue], args=[count, prefix, deadline, self.lease_expire, *task_ids])
+        tasks = map(self.make_task, result[::2], result[1::2], repeat(queue_name))
+        return [task for task in tasks if task]
+
+    async def bpop_tasks(self, queue_names: list[str], count=1) -> list[Task]:
+        """所有队列均为空时, 在全部队列上 BZPOPMIN 阻塞等待, 唤醒后取该任务数据的同时补齐本批剩余数量"""
+        keys = {self.get_queue("tasks", base=queue_name): queue_name for queue_name in queue_names}
+        # BZPOPMIN 返回 (key, member, score); 弹出后紧接着由 pop_tasks 写入租约, 两者之间只有一次往返
+        popped = await self.redis.bzpopmin(list(keys), timeout=self.block_timeout)
+        if not popped:
+            return []
+        key, task_id = [item.decode() if isinstance(item, bytes) else item for item in popped[:2]]
+        return await self.pop_tasks(keys[key], count - 1, task_id)
+
+    async def create_group(self, queue_name=None):
+        stream_queue = self.get_queue("stream", base=queue_name or self.queue_name)
+        try:
+            await self.redis.xgroup_create(stream_queue, setting.STREAM_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read_streams(self, queue_names: list[str], count=1, block=False) -> list[Task]:
+        """
+        stream 后端拉取任务
+
+        每隔 STREAM_CLAIM_INTERVAL 先认领其他消费者超时未确认的条目;
+        多个队列时先按调度顺序逐个非阻塞读取, 都为空时再在全部 stream 上阻塞读取
+        """
+        tasks = []
+        if time.monotonic() - self.last_claim >= setting.STREAM_CLAIM_INTERVAL:
+            self.last_claim = time.monotonic()
+            for queue_name in queue_names:
+                if len(tasks) >= count:
+                    break
+                tasks.extend(await self.claim_stream(queue_name, count - len(tasks)))
+        if tasks:
+            return tasks
+        if len(queue_names) > 1:
+            for queue_name in queue_names:
+                if tasks := await self.read_stream([queue_name], count=count):
+                    return tasks
+        return await self.read_stream(queue_names, count=count, block=block)
+
+    async def read_stream(self, queue_names: list[str], count=1, block=False) -> list[Task]:
+        streams = {self.get_queue("stream", base=queue_name): queue_name for queue_name in queue_names}
+        timeout = int(self.block_timeout * 1000) if block and self.blocking else None
+        response = await self.redis.xreadgroup(
+            setting.STREAM_GROUP,
+            self.consumer,
+            {stream: ">" for stream in streams},
+            count=count,
+            block=timeout
+        )
+        if isinstance(response, dict):
+            response = response.items()
+        tasks = []
+        for stream, entries in response or []:
+            queue_name = streams[stream.decode() if isinstance(stream, bytes) else stream]
+            tasks.extend(map(self.make_stream_task, entries, repeat(queue_name)))
+        return [task for task in tasks if task]
+
+    async def claim_stream(self, queue_name: str, count=1) -> list[Task]:
+        if await self.get_redis_version() < XAUTOCLAIM_VERSION:
+            return []
+        response = await self.redis.xautoclaim(
+            self.get_queue("stream", base=queue_name),
+            setting.STREAM_GROUP,
+            self.consumer,
+            min_idle_time=setting.STREAM_CLAIM_IDLE,
+            start_id=self.claim_start.get(queue_name, "0-0"),
+            count=count
+        )
+        self.claim_start[queue_name], entries = response[0], response[1]
+        if entries:
+            self.log(f"认领超时未确认的任务 {len(entries)} 个, queue={queue_name}")
+        tasks = map(self.make_stream_task, entries, repeat(queue_name))
+        return [task for task in tasks if task]
+
+    def make_stream_task(self, entry, queue_name=None):
+        entry_id, fields = entry
+        if not fields:
+            return None
+
+        def field(name):
+            return fields.get(name.encode(), fields.get(name))
+
+        # 条目 id 为 <毫秒时间戳>-<序号>
+        entry_ms = (entry_id.decode() if isinstance(entry_id, bytes) else entry_id).split("-")[0]
+        task = self.make_task(field("task_id"), field("data"), queue_name, int(entry_ms) / 1000)
+        if task:
+            task.entry_id = entry_id
+        return task
+
+    async def ack(self, task: Task):
+        """任务完成后确认, stream 后端确认后删除条目"""
+        entry_id = getattr(task, "entry_id", None)
+        if self.backend == "stream" and entry_id:
+            stream_queue = self.get_queue("stream", base=task.queue_name or self.queue_name)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.xack(stream_queue, setting.STREAM_GROUP, entry_id)
+                await pipe.xdel(stream_queue, entry_id)
+                await pipe.execute()
+
+    async def zpop(self, key: str, count=1) -> list[str]:
+        if count <= 0:
+            return []
+        if await self.get_redis_version() >= ZPOP_VERSION:
+            result = await self.redis.zpopmin(key, count=count)
+            result = [member for member, *_ in result or []]
         else:
             async with self.redis.pipeline(transaction=True) as pipe:
                 # 取出最小分数的任务
-                await pipe.zrange(key, 0, 0, withscores=False)
-                # 删除它
-                await pipe.zremrangebyrank(key, 0, 0)
+                await pipe.zrange(key, 0, count - 1, withscores=False)
+                # 删除它们
+                await pipe.zremrangebyrank(key, 0, count - 1)
                 result, _ = await pipe.execute()
 
-        if result:
-            return result[0].decode() if isinstance(result[0], bytes) else result[0]
-        return None
+        return [member.decode() if isinstance(member, bytes) else member for member in result or []]
 
     async def put_result(self, result, task):
-        result_queue = self.get_queue(task.task_id, base=self.result_queue)
-        data = task.encode_data(result)
-        await self.redis.publish(result_queue, data)
+        result_queue = task.result_queue or self.get_queue(task.task_id, base=self.result_queue)
+        data = await self.offload(task.encode_data(result))
+        queue_name = task.queue_name or self.queue_name
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.publish(result_queue, data)
+            await self.release(pipe, task)
+            # 可重试的任务清除失败次数与重试策略
+            if self.retry_policies.get(queue_name) or task.has_retry():
+                await pipe.delete(self.get_queue("attempts", task.task_id, base=queue_name))
+            task.has_retry() and await pipe.delete(self.get_queue("retry", task.task_id, base=queue_name))
+            await pipe.execute()
+        # 任务已完成, 外置的任务数据不再需要; 重试与放回队列时沿用 task.raw, 不会走到这里
+        try:
+            await self.delete_blob(task.raw)
+        except Exception as e:
+            self.log(f"删除外置数据失败 task_id={task.task_id}: {type(e).__name__}: {e}", level="error")
 
 
 if __name__ == '__main__':
@@ -8,15 +8,28 @@
 """
 import asyncio
 import json
+import math
+import os
+import time
+from typing import Literal, AsyncIterator, Iterable
+from uuid import uuid4
 
 from ytools import logger as default_logger
 from ytools.utils.counter import FastWriteCounter
 from ytools.utils.host_ip import get_local_ip
 from ytools.utils.magic import require
+from ytools.utils.package import parse, Version
 
 require("redis")
 from redis.asyncio import Redis  # noqa
-from ytools.arq import setting
+from redis.commands.core import AsyncScript  # noqa
+from ytools.arq import setting, scripts
+from ytools.arq.client import pool
+from ytools.arq.client.router import ResultRouter
+from ytools.arq.retry import RetryPolicy
+from ytools.arq.task import blob, codec
+from ytools.arq.task.codec import get_codec, get_compressor, SAFE_CODECS
+from ytools.arq.task.task import Task
 
 
 class BaseClient:
@@ -27,6 +40,9 @@ class BaseClient:
     data_queue: str
     result_queue: str
     status_queue: str
+    stream_queue: str
+    delayed_queue: str
+    processing_queue: str
 
     def __init__(
             self,
@@ -34,35 +50,134 @@ class BaseClient:
             redis=None,
             logger=None,
             level="info",
+            backend: Literal["zset", "stream"] = None,
+            codec: str = None,
+            accept: Iterable[str] = None,
+            compress: str = None,
+            compress_threshold: int = None,
+            worker_id: str = None,
+            heartbeat_interval: float = None,
+            offload_threshold: int = None,
+            offload_store: "str | blob.BlobStore" = None,
     ):
+        self.backend = backend or setting.BACKEND
+        # 任务数据/结果的编解码器, 写入数据头部, 消费端据此解码
+        self.codec = codec or setting.CODEC
+        self.codec and get_codec(self.codec)
+        # 允许解码的编解码器: raw / json、自身的 codec 及 accept 中显式开启的
+        self.accept = {*SAFE_CODECS, *([self.codec] if self.codec else []), *(setting.ACCEPT_CODECS if accept is None else accept)}
+        for name in self.accept:
+            get_codec(name)
+        # 压缩算法及阈值, 任务数据与结果均生效
+        self.compress = compress or setting.COMPRESS
+        self.compress and get_compressor(self.compress)
+        self.compress_threshold = setting.COMPRESS_THRESHOLD if compress_threshold is None else compress_threshold
+        # 编码后超过阈值的任务数据/结果写入外置存储, 只传递引用
+        self.offload_threshold = setting.OFFLOAD_THRESHOLD if offload_threshold is None else offload_threshold
+        self.offload_store = offload_store or setting.OFFLOAD_STORE
+        self._blob_store: blob.BlobStore | None = None
         self.task_count = FastWriteCounter()
         self.extra = {}
         self.logger = logger or default_logger
         self.level = (level or "info").lower()
         self._host_ip = None
+        self.worker_id = worker_id
+        # 未指定 worker_id 时的默认 id, 带上进程号与随机后缀, 同一主机上的多个实例心跳互不覆盖
+        self._worker_id = None
+        # 心跳间隔, 为 0 时不上报心跳
+        self.heartbeat_interval = setting.HEARTBEAT_INTERVAL if heartbeat_interval is None else heartbeat_interval
+        self._redis_version: Version | None = None
+        self._scripts: dict[str, AsyncScript] = {}
+        self._router: ResultRouter | None = None
+        self._heartbeat: asyncio.Task | None = None
         self.set_queue(queue_name)
         if isinstance(redis, dict):
             self.redis = self.make_redis(**redis)
         elif isinstance(redis, str):
-            self.redis = Redis.from_url(redis)
+            self.redis = pool.get_redis(redis)
         elif redis:
             self.redis = redis
-        asyncio.create_task(self.heartbeat())
+        if self.heartbeat_interval:
+            self._heartbeat = asyncio.create_task(self.heartbeat())
 
     @property
     def info(self):
         return {
             "host_ip": self.get_host_ip(),
+            "worker_id": self.get_worker_id(),
             "task_count": self.task_count.value,
+            "redis_pool": pool.get_stats(self.redis.connection_pool),
             **self.extra
         }
 
+    @property
+    def router(self) -> ResultRouter:
+        """结果分发器, 首次等待结果时才会建立订阅; 同一连接池上订阅同一结果队列的客户端共用一个"""
+        if self._router is None:
+            self._router = ResultRouter.shared(self)
+        return self._router
+
+    @property
+    def blob_store(self) -> blob.BlobStore:
+        """写入外置数据使用的存储"""
+        if self._blob_store is None:
+            store = self.offload_store
+            if isinstance(store, blob.BlobStore):
+                self._blob_store = store
+            elif store == "redis":
+                self._blob_store = blob.RedisBlobStore(self.redis, self.get_queue("blob", ""))
+            else:
+                self._blob_store = blob.FileBlobStore(store.removeprefix("file://"))
+        return self._blob_store
+
+    def get_blob_store(self, ref: dict) -> blob.BlobStore:
+        """读取引用使用的存储, 与本端配置不同时按引用中的信息访问"""
+        if ref["store"] == self.blob_store.name:
+            return self.blob_store
+        if ref["store"] == "redis":
+            return blob.RedisBlobStore(self.redis, "")
+        if ref["store"] == "file":
+            return blob.FileBlobStore(ref["path"])
+        raise ValueError(f"未配置外置存储: {ref['store']}")
+
+    async def offload(self, data: bytes, ttl: int = None) -> bytes:
+        """数据超过 offload_threshold 时写入外置存储, 返回引用; 否则原样返回"""
+        if not self.offload_threshold or not isinstance(data, bytes) or len(data) < self.offload_threshold:
+            return data
+        ref = await self.blob_store.put(data, int(ttl or setting.OFFLOAD_EXPIRE))
+        return blob.make_ref(ref, codec.get_flags(data) & codec.RETRY_FLAG)
+
+    async def resolve(self, data):
+        """数据为外置存储的引用时读取完整数据, 否则原样返回"""
+        if not blob.is_ref(data):
+            return data
+        ref = blob.load_ref(data)
+        return await self.get_blob_store(ref).get(ref)
+
+    async def delete_blob(self, data):
+        """数据为外置存储的引用时删除外置数据"""
+        if blob.is_ref(data):
+            ref = blob.load_ref(data)
+            await self.get_blob_store(ref).delete(ref)
+
+    async def iter_data(self, data) -> AsyncIterator[bytes]:
+        """按块读取数据, 适合不需要整体载入内存的大结果"""
+        if not blob.is_ref(data):
+            yield data
+            return
+        ref = blob.load_ref(data)
+        async for chunk in self.get_blob_store(ref).iter(ref):
+            yield chunk
+
     def set_queue(self, queue_name):
         self.queue_name = queue_name or setting.DEFAULT_QUEUE_NAME
         self.tasks_queue = self.get_queue("tasks")
         self.data_queue = self.get_queue("data")
         self.result_queue = self.get_queue("result")
         self.status_queue = self.get_queue("status")
+        self.stream_queue = self.get_queue("stream")
+        self.delayed_queue = self.get_queue("delayed")
+        self.processing_queue = self.get_queue("processing")
 
     def get_queue(self, *queue: str, base=None):
         return self.split.join([base or self.queue_name, *queue])
@@ -86,6 +201,212 @@ class BaseClient:
             self._host_ip = "unknown"
         return self._host_ip
 
+    async def enqueue(self, pipe, tasks: list[Task]) -> list[Task]:
+        """
+        把一批任务写入 pipeline, 返回实际写入的任务; 外置数据已过期的任务无法重新投放, 会被跳过
+
+        未到期(task.eta)的任务进入延迟队列, 数据 key 的过期时间顺延; zset 后端同时在数据头部写入投放(到期)时间;
+        zset 后端每个队列只有一次 ZADD 映射 + 批量 SET EX, stream 后端为批量 XADD
+        """
+        now = time.time()
+        ready, delayed = {}, {}
+        written = []
+        for task in tasks:
+            queue_name = task.queue_name or self.queue_name
+            delay = task.eta - now if task.eta else 0
+            # 外置数据与数据 key 同时过期
+            ttl = setting.EXPIRE_TIME + math.ceil(max(delay, 0))
+            if task.raw is None:
+                data = await self.offload(task.encode_data(), ttl)
+            else:
+                data = task.raw
+                if blob.is_ref(data):
+                    ref = blob.load_ref(data)
+                    if not await self.get_blob_store(ref).touch(ref, ttl):
+                        self.log(f"外置数据已过期, 跳过任务 task_id={task.task_id}: {ref['key']}", level="error")
+                        continue
+            data_queue = self.get_queue("data", task.task_id, base=queue_name)
+            if task.retry:
+                retry_queue = self.get_queue("retry", task.task_id, base=queue_name)
+                await pipe.set(retry_queue, json.dumps(RetryPolicy.make(task.retry).to_dict()), ex=setting.RETRY_EXPIRE)
+            if self.backend != "stream":
+                # 用于统计排队等待时间, 只有带头部的数据才能记录; stream 条目 id 自带时间戳, 无需另外记录
+                data = codec.stamp(data, now + max(delay, 0))
+            if delay > 0:
+                delayed.setdefault(queue_name, {})[task.task_id] = task.eta
+                await pipe.set(data_queue, data, ex=ttl)
+            elif self.backend == "stream":
+                fields = {"task_id": task.task_id, "data": data}
+                await pipe.xadd(self.get_queue("stream", base=queue_name), fields, maxlen=setting.STREAM_MAXLEN, approximate=True)
+            else:
+                ready.setdefault(queue_name, {})[task.task_id] = task.score
+                await pipe.set(data_queue, data, ex=setting.EXPIRE_TIME)
+            written.append(task)
+        for queue_name, mapping in ready.items():
+            await pipe.zadd(self.get_queue("tasks", base=queue_name), mapping)
+        for queue_name, mapping in delayed.items():
+            await pipe.zadd(self.get_queue("delayed", base=queue_name), mapping)
+        return written
+
+    async def promote(self, queue_name=None, batch_size=None) -> int:
+        """
+        把延迟队列中已到期的任务移入就绪队列, 一次最多移动 batch_size 个
+
+        先取出到期的任务 id, 再在一次 lua 调用中移动, 脚本用到的数据 key 都通过 KEYS 传入
+        """
+        queue_name = queue_name or self.queue_name
+        now = time.time()
+        delayed_queue = self.get_queue("delayed", base=queue_name)
+        task_ids = await self.redis.zrangebyscore(delayed_queue, "-inf", now, start=0, num=batch_size or setting.DELAY_BATCH)
+        if not task_ids:
+            return 0
+        task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in task_ids]
+        if self.backend == "stream":
+            ready_queue = self.get_queue("stream", base=queue_name)
+            data_queues = [self.get_queue("data", task_id, base=queue_name) for task_id in task_ids]
+        else:
+            ready_queue, data_queues = self.get_queue("tasks", base=queue_name), []
+        return await self.get_script(scripts.PROMOTE_TASKS)(
+            keys=[delayed_queue, ready_queue, *data_queues],
+            args=[now, self.backend, setting.STREAM_MAXLEN or 0, *task_ids]
+        )
+
+    async def reap(self, queue_name=None, batch_size=None) -> int:
+        """
+        把租约已过期(持有的 Agent 已失联)的任务重新放回就绪队列, 一次最多处理 batch_size 个
+
+        先取出租约过期的任务 id, 再在一次 lua 调用中确认仍未续约后放回, 脚本用到的数据 key 都通过 KEYS 传入
+        """
+        queue_name = queue_name or self.queue_name
+        now = time.time()
+        processing_queue = self.get_queue("processing", base=queue_name)
+        task_ids = await self.redis.zrangebyscore(processing_queue, "-inf", now, start=0, num=batch_size or setting.LEASE_BATCH)
+        if not task_ids:
+            return 0
+        task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in task_ids]
+        return await self.get_script(scripts.REAP_LEASES)(
+            keys=[processing_queue, self.get_queue("tasks", base=queue_name), *[self.get_queue("data", task_id, base=queue_name) for task_id in task_ids]],
+            args=[now, *task_ids]
+        )
+
+    async def get_dead_tasks(self, start=0, end=-1, queue_name=None) -> list[dict]:
+        """查看死信队列, 按进入时间排序"""
+        queue_name = queue_name or self.queue_name
+        dead = await self.redis.zrange(self.get_queue("dead", base=queue_name), start, end, withscores=True)
+        if not dead:
+            return []
+        task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id, _ in dead]
+        errors = await self.redis.hmget(self.get_queue("dead", "error", base=queue_name), task_ids)
+        return [
+            {
+                "task_id": task_id,
+                "time": ts,
+                "error": error.decode() if isinstance(error, bytes) else error
+            }
+            for task_id, (_, ts), error in zip(task_ids, dead, errors)
+        ]
+
+    async def requeue_dead_tasks(self, task_ids: list[str] = None, queue_name=None) -> int:
+        """把死信队列中的任务重新投放至就绪队列, 不传 task_ids 时全部重新投放, 重试次数清零"""
+        queue_name = queue_name or self.queue_name
+        dead_queue = self.get_queue("dead", base=queue_name)
+        dead_data = self.get_queue("dead", "data", base=queue_name)
+        dead_error = self.get_queue("dead", "error", base=queue_name)
+        if task_ids is None:
+            task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in await self.redis.zrange(dead_queue, 0, -1)]
+        count = 0
+        for i in range(0, len(task_ids), setting.BATCH_SIZE):
+            batch = task_ids[i:i + setting.BATCH_SIZE]
+            tasks = [
+                Task(data=data, client=self, task_id=task_id, queue_name=queue_name, raw=data)
+                for task_id, data in zip(batch, await self.redis.hmget(dead_data, batch))
+                if data is not None
+            ]
+            async with self.redis.pipeline(transaction=True) as pipe:
+                tasks = await self.enqueue(pipe, tasks)
+                # 未能投放的任务留在死信队列中
+                if requeued := [task.task_id for task in tasks]:
+                    await pipe.zrem(dead_queue, *requeued)
+                    await pipe.hdel(dead_data, *requeued)
+                    await pipe.hdel(dead_error, *requeued)
+                    await pipe.delete(*[self.get_queue("attempts", task_id, base=queue_name) for task_id in requeued])
+                await pipe.execute()
+            count += len(tasks)
+        return count
+
+    async def get_queue_size(self) -> int:
+        """队列中尚未完成的任务数"""
+        if self.backend == "stream":
+            return await self.redis.xlen(self.stream_queue)
+        return await self.redis.zcard(self.tasks_queue)
+
+    async def get_stats(self, queue_name=None, roles=("agent", "supervisor", "client")) -> dict:
+        """
+        汇总队列状态: 就绪、延迟、执行中、死信任务数, 以及各实例最近一次上报的心跳
+
+        心跳 key 为 <queue>:<角色>:<worker_id>, 通过 SCAN 查找后用一个 pipeline 取回
+        """
+        queue_name = queue_name or self.queue_name
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if self.backend == "stream":
+                await pipe.xlen(self.get_queue("stream", base=queue_name))
+                await pipe.xpending(self.get_queue("stream", base=queue_name), setting.STREAM_GROUP)
+            else:
+                await pipe.zcard(self.get_queue("tasks", base=queue_name))
+                await pipe.zcard(self.get_queue("processing", base=queue_name))
+            await pipe.zcard(self.get_queue("delayed", base=queue_name))
+            await pipe.zcard(self.get_queue("dead", base=queue_name))
+            ready, in_flight, delayed, dead = await pipe.execute(raise_on_error=False)
+        if self.backend == "stream":
+            # 消费组不存在时 XPENDING 报错; 已读取未确认的条目仍在 stream 中
+            in_flight = in_flight.get("pending", 0) if isinstance(in_flight, dict) else 0
+            ready -= in_flight
+        keys = []
+        for role in roles:
+            async for key in self.redis.scan_iter(match=self.get_queue(role, "*", base=queue_name), count=1000):
+                keys.append((role, key))
+        workers = []
+        if keys:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for _, key in keys:
+                    await pipe.get(key)
+                values = await pipe.execute()
+            for (role, _), value in zip(keys, values):
+                value and workers.append({"role": role, **json.loads(value)})
+        return {
+            "queue": queue_name,
+            "backend": self.backend,
+            "ready": ready,
+            "delayed": delayed,
+            "in_flight": in_flight,
+            "dead": dead,
+            "workers": workers,
+        }
+
+    async def get_redis_version(self) -> Version:
+        """获取 redis 版本, 只在首次调用时执行 INFO server"""
+        if self._redis_version is None:
+            try:
+                version = (await self.redis.info("server")).get("redis_version", "0.0.0")
+                self._redis_version = parse(version)
+            except Exception as e:
+                self.log(f"获取 redis 版本失败: {e}", level="error")
+                self._redis_version = parse("0.0.0")
+        return self._redis_version
+
+    def get_script(self, script: str) -> AsyncScript:
+        """注册 lua 脚本, 调用时走 EVALSHA, 服务端缺失时自动重新加载"""
+        if script not in self._scripts:
+            self._scripts[script] = self.redis.register_script(script)
+        return self._scripts[script]
+
+    def get_worker_id(self):
+        if self.worker_id:
+            return self.worker_id
+        if not self._worker_id:
+            self._worker_id = f"{self.get_host_ip()}:{os.getpid()}:{uuid4().hex[:6]}"
+        return self._worker_id
+
     @classmethod
     def make_redis(
             cls,
@@ -95,7 +416,8 @@ class BaseClient:
             password=None,
             **kwargs
     ):
-        return Redis(host=host, port=port, db=db, password=password, **kwargs)
+        """使用共享连接池, 可传入 max_connections / health_check_interval"""
+        return pool.get_redis(host=host, port=port, db=db, password=password, **kwargs)
 
     @classmethod
     def from_redis(cls, queue_name=None, **redis_config):
@@ -117,13 +439,25 @@ class BaseClient:
         status_queue = self.get_queue(status_id, base=self.status_queue)
         return await self.redis.delete(status_queue)
 
+    @property
+    def heartbeat_queue(self):
+        return self.get_queue(self.__class__.__name__.lower(), self.get_worker_id(), base=self.queue_name)
+
     async def heartbeat(self):
-        interval = 5
+        interval = self.heartbeat_interval
         while True:
-            h_key = self.get_queue(self.__class__.__name__.lower(), self.get_host_ip(), base=self.queue_name)
-            await self.redis.set(h_key, value=json.dumps(self.info), ex=interval + 1)
+            await self.redis.set(self.heartbeat_queue, value=json.dumps(self.info), ex=int(interval) + 1)
             await asyncio.sleep(interval)
 
+    async def deregister(self):
+        """停止心跳并删除心跳 key, 不必等待过期即可从 stats 中消失"""
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            # 等待正在写入的心跳结束, 避免删除后又被写回
+            await asyncio.wait([self._heartbeat], timeout=1)
+            self._heartbeat = None
+        await self.redis.delete(self.heartbeat_queue)
+
 
 if __name__ == '__main__':
     pass
@@ -7,12 +7,13 @@
 @Desc    : 
 """
 import asyncio
+import contextlib
 import inspect
-from typing import Literal
+import time
+from datetime import datetime
+from typing import Literal, Iterable, Callable, Any, AsyncIterable, AsyncIterator
 from uuid import uuid4
 
-from redis.asyncio.client import Pipeline
-
 from ytools.arq import setting
 from ytools.arq.client.base import BaseClient
 from ytools.arq.task.task import Task
@@ -21,44 +22,359 @@ from ytools.arq.task.task import Task
 class Client(BaseClient):
     max_sleep_time = 5
 
-    def __init__(self, *args, max_task_num: int = None, max_action: Literal["sleep", "break", "raise"] = "sleep", **kwargs):
+    def __init__(
+            self,
+            *args,
+            max_task_num: int = None,
+            max_action: Literal["sleep", "break", "raise"] = "sleep",
+            batch_size: int = None,
+            auto_batch: bool | float = False,
+            dedup_func: Callable[[Any], str | None] = None,
+            dedup_ttl: int = None,
+            **kwargs
+    ):
         self.max_task_num = max_task_num
         self.max_action = max_action
+        self.batch_size = batch_size or setting.BATCH_SIZE
+        # 自动合批: True 使用默认窗口, 传入数字则作为窗口秒数
+        self.batch_window = setting.BATCH_WINDOW if auto_batch is True else (auto_batch or 0)
+        self._pending: list[tuple[Task, asyncio.Future]] = []
+        self._flusher: asyncio.Task | None = None
+        # 去重: 未显式传入 dedup_key 时用 dedup_func(data) 计算, 返回 None 表示不去重
+        self.dedup_func = dedup_func
+        self.dedup_ttl = dedup_ttl or setting.DEDUP_TTL
+        # 设置 max_task_num 时使用的队列深度估计: 后台定时刷新, 每次投放在本地累加, 投放不再额外查询队列长度
+        self.depth: int | None = None
+        self.depth_waiters = 0
+        self._space = asyncio.Event()
+        self._kick = asyncio.Event()
+        self._watcher: asyncio.Task | None = None
         super().__init__(*args, **kwargs)
 
-    async def put(self, data, task_id=None, **kwargs):
+    def make_task(self, data, task_id=None, eta: float | datetime = None, countdown: float = None, **kwargs):
+        """
+        创建任务
+
+        :param eta: 到期执行时间, 时间戳或 datetime
+        :param countdown: 延迟执行秒数, 优先于 eta
+        :param kwargs: 其他任务属性, 如 retry=RetryPolicy(...) 为该任务单独指定重试策略, dedup_key="..." 指定去重 key
+        """
         task_id = task_id or str(uuid4())
-        task = Task(data=data, client=self, task_id=task_id, result_queue=self.get_queue(task_id, base=self.result_queue), **kwargs)
-        await self.put_task(task, kwargs.get('auto_ensure', False))
+        if kwargs.get("dedup_key") is None and self.dedup_func:
+            kwargs["dedup_key"] = self.dedup_func(data)
+        if countdown:
+            eta = time.time() + countdown
+        elif isinstance(eta, datetime):
+            eta = eta.timestamp()
+        return Task(data=data, client=self, task_id=task_id, result_queue=self.get_queue(task_id, base=self.result_queue), eta=eta, **kwargs)
+
+    async def put(self, data, task_id=None, **kwargs):
+        task = self.make_task(data, task_id, **kwargs)
+        if self.batch_window:
+            await self.put_later(task, kwargs.get('auto_ensure', False))
+        else:
+            await self.put_task(task, kwargs.get('auto_ensure', False))
         return task
 
     async def put_task(self, task: Task, auto_ensure=False):
-        data_queue = self.get_queue(task.task_id, base=self.data_queue)
-
         auto_ensure and await task.ensure()
-        async with self.redis.pipeline(transaction=True) as pipe:
-            if self.max_task_num and await self.check_max(pipe):
-                return
-            await pipe.zadd(self.tasks_queue, {task.task_id: task.score})
-            await pipe.set(data_queue, task.encode_data(), ex=setting.EXPIRE_TIME)
+        await self.put_tasks([task])
+
+    async def put_many(self, items: Iterable, batch_size: int = None, auto_ensure=False, **kwargs) -> list[Task]:
+        """
+        批量投放任务, 每批只有一次往返
+
+        :param items: 任务数据, 元素也可以直接是 Task
+        :param batch_size: 每批任务数, 默认使用 self.batch_size
+        :param auto_ensure: 是否在投放前订阅结果
+        :param kwargs: 透传给每个 Task 的参数
+        :return: 成功投放的任务
+        """
+        batch_size = batch_size or self.batch_size
+        tasks, batch = [], []
+        for item in items:
+            batch.append(item if isinstance(item, Task) else self.make_task(item, **kwargs))
+            if len(batch) >= batch_size:
+                tasks.extend(await self._put_batch(batch, auto_ensure))
+                batch = []
+        if batch:
+            tasks.extend(await self._put_batch(batch, auto_ensure))
+        return tasks
+
+    async def _put_batch(self, tasks: list[Task], auto_ensure=False):
+        if auto_ensure:
+            await asyncio.gather(*[task.ensure() for task in tasks])
+        return await self.put_tasks(tasks)
+
+    async def put_tasks(self, tasks: list[Task]) -> list[Task]:
+        """
+        在一个 pipeline 中写入一批任务, 见 BaseClient.enqueue
+
+        设置了 max_task_num 时, 每批写入前都会检查队列容量, 只写入容量允许的部分;
+        重复的任务不会写入, 直接作为已存在任务的句柄返回
+        """
+        pending, duplicates = await self.dedup(tasks)
+        done = set(map(id, duplicates))
+        try:
+            while pending:
+                num = await self.check_max(len(pending)) if self.max_task_num else len(pending)
+                if not num:
+                    self.log(f"超出最大任务数: {self.max_task_num}, 丢弃 {len(pending)} 个任务", level="warning")
+                    await self.release_dedup(pending)
+                    break
+                batch = pending[:num]
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    await self.enqueue(pipe, batch)
+                    results = await pipe.execute()
+                pending = pending[num:]
+                if not all(results):  # 检查是否有命令失败
+                    raise ValueError(f"投放任务至队列失败: {results}")
+                self.task_count.increment(len(batch))
+                done.update(map(id, batch))
+                self._router and self._router.expect(task.task_id for task in batch)
+        except BaseException:
+            # 未写入的任务释放去重 key, 否则 dedup_ttl 内相同 key 的任务都会指向不存在的任务
+            await self.release_dedup(pending)
+            raise
+        return [task for task in tasks if id(task) in done]
+
+    async def dedup(self, tasks: list[Task]) -> tuple[list[Task], list[Task]]:
+        """
+        按 dedup_key 去重, 一次往返中对每个去重 key 执行 SET NX + GET
+
+        抢占到去重 key 的任务正常写入; 抢占失败的任务改为指向已存在的任务 id, 调用方仍可等待原任务的结果
+
+        :return: (需要写入的任务, 重复的任务)
+        """
+        unique = [task for task in tasks if task.dedup_key]
+        if not unique:
+            return tasks, []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task in unique:
+                dedup_queue = self.get_queue("dedup", task.dedup_key, base=task.queue_name or self.queue_name)
+                await pipe.set(dedup_queue, task.task_id, nx=True, ex=self.dedup_ttl)
+                await pipe.get(dedup_queue)
             results = await pipe.execute()
-            if not all(results):  # 检查是否有命令失败
-                raise ValueError(f"投放任务至队列失败: {results}")
-            self.task_count.increment()
+        duplicates = []
+        for task, claimed, task_id in zip(unique, results[::2], results[1::2]):
+            if claimed or task_id is None:
+                continue
+            task_id = task_id.decode() if isinstance(task_id, bytes) else task_id
+            self.log(f"重复任务 dedup_key={task.dedup_key}, 指向已存在的任务 task_id={task_id}", level="debug")
+            task.duplicate = True
+            task.task_id = task_id
+            task.result_queue = self.get_queue(task_id, base=self.result_queue)
+            if task.result:
+                # 已经按原 id 订阅了结果, 改为等待已存在任务的结果
+                task.result.cancel()
+                await task.ensure()
+            duplicates.append(task)
+        return [task for task in tasks if not task.duplicate], duplicates
 
-    async def check_max(self, pipe: Pipeline):
-        while True:
-            now_task_num = await pipe.zcard(self.tasks_queue)
-            if now_task_num >= self.max_task_num:
-                if self.max_action == "sleep":
-                    self.log(f"当前任务数量: {now_task_num} 超出最大任务数: {self.max_task_num}, 等待任务消费, 休眠 {self.max_sleep_time}s...")
-                    await asyncio.sleep(self.max_sleep_time)
-                elif self.max_action == "break":
-                    return True
+    async def release_dedup(self, tasks: list[Task]):
+        """释放未写入任务占用的去重 key"""
+        if keys := [self.get_queue("dedup", task.dedup_key, base=task.queue_name or self.queue_name) for task in tasks if task.dedup_key]:
+            await self.redis.delete(*keys)
+
+    async def map(
+            self,
+            func: str | Callable,
+            iterable: Iterable | AsyncIterable,
+            concurrency: int = None,
+            ordered: bool = False,
+            timeout: float = None,
+            **kwargs
+    ) -> AsyncIterator:
+        """
+        把 iterable 中的每个元素作为 func 的参数分发到 Agent 执行, 以异步迭代器返回结果
+
+        按需从 iterable 取数据并分批投放, 已投放但还未返回给调用方的任务至多 concurrency 个, 输入无限长时内存占用也保持不变;
+        所有结果经同一个结果订阅返回. 去重后重复的输入返回已存在任务的结果;
+        设置了 max_task_num 且 max_action="break" 时, 未能投放的任务不会有结果, 直接抛出 ValueError
+
+        async for res in client.map("math:sqrt", range(10000), concurrency=200):
+            ...
+
+        :param func: 函数路径, 如 path.to:func, 也可以是模块级函数
+        :param iterable: 参数, 同步或异步可迭代对象
+        :param concurrency: 最大在途任务数, 默认使用 self.batch_size
+        :param ordered: 是否按输入顺序返回, 否则按完成顺序返回
+        :param timeout: 等待下一个结果的超时时间
+        :param kwargs: 透传给每个 Task 的参数
+        """
+        if not isinstance(func, str):
+            func = f"{func.__module__}:{func.__qualname__}"
+        concurrency = concurrency or self.batch_size
+        if isinstance(iterable, AsyncIterable):
+            iterator, is_async = aiter(iterable), True
+        else:
+            iterator, is_async = iter(iterable), False
+        exhausted = False
+
+        async def take(n):
+            nonlocal exhausted
+            items = []
+            while len(items) < n:
+                try:
+                    items.append(await anext(iterator) if is_async else next(iterator))
+                except (StopIteration, StopAsyncIteration):
+                    exhausted = True
+                    break
+            return items
+
+        # 在途任务: future -> [(序号, task)], 去重后指向同一任务的输入共用一个 future; ordered 模式下已完成但还未轮到的结果暂存在 done 中
+        running: dict[asyncio.Future, list[tuple[int, Task]]] = {}
+        inflight: dict[str, asyncio.Future] = {}
+        # 带去重 key 的任务结果, 之后重复的输入指向已完成的任务时直接复用
+        completed: dict[str, Any] = {}
+        done: dict[int, Any] = {}
+        submitted = yielded = 0
+        try:
+            while True:
+                if not exhausted and submitted - yielded < concurrency:
+                    items = await take(min(concurrency - (submitted - yielded), self.batch_size))
+                    tasks = [self.make_task({"func": func, "args": [item]}, **kwargs) for item in items]
+                    for task in tasks:
+                        await task.ensure()
+                    # 去重会改写 task_id 与 task.result, 以写入后的任务为准
+                    written = set(map(id, await self.put_tasks(tasks))) if tasks else set()
+                    if len(written) < len(tasks):
+                        for task in tasks:
+                            task.result.cancel()
+                        raise ValueError(f"超出最大任务数: {self.max_task_num}, {len(tasks) - len(written)} 个任务未投放")
+                    for task in tasks:
+                        if task.task_id in completed:
+                            task.result.cancel()
+                            done[submitted] = completed[task.task_id]
+                        elif task.task_id in inflight:
+                            task.result.cancel()
+                            running[inflight[task.task_id]].append((submitted, task))
+                        else:
+                            inflight[task.task_id] = task.result
+                            running[task.result] = [(submitted, task)]
+                        submitted += 1
+                    continue
+                if not running and not done:
+                    return
+                if running and not (ordered and yielded in done):
+                    finished, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if not finished:
+                        raise asyncio.TimeoutError(f"等待结果超时: {timeout}s")
+                    for future in finished:
+                        entries = running.pop(future)
+                        task = entries[0][1]
+                        inflight.pop(task.task_id, None)
+                        res = task.decode_data(await self.resolve(future.result()))
+                        if task.dedup_key:
+                            completed[task.task_id] = res
+                        for index, _ in entries:
+                            done[index] = res
+                if ordered:
+                    while yielded in done:
+                        yield done.pop(yielded)
+                        yielded += 1
                 else:
-                    raise ValueError("超出最大任务数")
+                    for index in list(done):
+                        yield done.pop(index)
+                        yielded += 1
+        finally:
+            for future in running:
+                future.cancel()
+
+    async def put_later(self, task: Task, auto_ensure=False):
+        """自动合批: 窗口期内的 put 合并为一次 pipeline 写入, 每个调用方等待自己的任务写入完成"""
+        auto_ensure and await task.ensure()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((task, future))
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        """立即写入自动合批中等待的任务"""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            done = await self.put_tasks([task for task, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                future.done() or future.set_exception(e)
+            return
+        done = {id(task) for task in done}
+        for task, future in pending:
+            future.done() or future.set_result(id(task) in done)
+
+    async def check_max(self, num=1):
+        """
+        返回当前可投放的任务数, 并在本地深度估计中预占
+
+        队列已满时 sleep 模式等待后台刷新发现有空位后被唤醒, 最长等待 max_sleep_time 秒后重新检查
+        """
+        if self.depth is None:
+            await self.refresh_depth()
+        if not self._watcher:
+            self._watcher = asyncio.create_task(self.watch_depth())
+        logged = False
+        while True:
+            free = self.max_task_num - self.depth
+            if free >= num or (free > 0 and self.max_action in ("sleep", "break")):
+                num = min(num, free)
+                self.depth += num
+                return num
+            if self.max_action == "break":
+                return 0
+            if self.max_action != "sleep":
+                raise ValueError("超出最大任务数")
+            if not logged:
+                logged = True
+                self.log(f"当前任务数量: {self.depth} 超出最大任务数: {self.max_task_num}, 等待任务消费...")
+            self._space.clear()
+            self._kick.set()
+            self.depth_waiters += 1
+            try:
+                await asyncio.wait_for(self._space.wait(), self.max_sleep_time)
+            except asyncio.TimeoutError:
+                await self.refresh_depth()
+            finally:
+                self.depth_waiters -= 1
+
+    async def refresh_depth(self):
+        self.depth = await self.get_queue_size()
+        if self.depth < self.max_task_num:
+            self._space.set()
+
+    async def watch_depth(self):
+        """
+        后台刷新队列深度
+
+        平时每 DEPTH_REFRESH_INTERVAL 秒刷新一次; 有投放开始等待时立即刷新,
+        之后从 DEPTH_MIN_INTERVAL 起按 2 倍放宽间隔, 直到出现空位唤醒等待方
+        """
+        interval = setting.DEPTH_REFRESH_INTERVAL
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._kick.wait(), interval)
+            if self._kick.is_set():
+                self._kick.clear()
+                interval = setting.DEPTH_MIN_INTERVAL
+            try:
+                await self.refresh_depth()
+            except Exception as e:
+                self.log(f"刷新队列深度失败: {type(e).__name__}: {e}", level="error")
+            if not self.depth_waiters:
+                interval = setting.DEPTH_REFRESH_INTERVAL
+            elif self.depth >= self.max_task_num:
+                interval = min(interval * 2, setting.DEPTH_REFRESH_INTERVAL)
             else:
-                return
+                interval = setting.DEPTH_MIN_INTERVAL
 
     @staticmethod
     async def get_result(task: Task, timeout=None, timeout_back=None):
@@ -66,33 +382,19 @@ class Client(BaseClient):
         return res
 
     async def get_result_by_id(self, task_id, timeout=None, timeout_back=None):
-        result_queue = self.get_queue(task_id, base=self.result_queue)
-        pubsub = self.redis.pubsub()
-        await pubsub.subscribe(result_queue)
-
-        async def get_result():
-            async for msg in pubsub.listen():
-                if msg["type"] == "message":
-                    return msg["data"]
-
+        future = await self.router.wait(task_id)
         try:
-            done_future = asyncio.ensure_future(get_result())
-            try:
-                res = await asyncio.wait_for(done_future, timeout=timeout)
-                return res
-            except asyncio.TimeoutError:
-                if inspect.iscoroutinefunction(timeout_back):
-                    await timeout_back()
-                elif inspect.isawaitable(timeout_back):
-                    await timeout_back
-                elif timeout_back:
-                    timeout_back()
-                raise
-            finally:
-                done_future.cancel()
+            return await self.resolve(await asyncio.wait_for(future, timeout=timeout))
+        except asyncio.TimeoutError:
+            if inspect.iscoroutinefunction(timeout_back):
+                await timeout_back()
+            elif inspect.isawaitable(timeout_back):
+                await timeout_back
+            elif timeout_back:
+                timeout_back()
+            raise
         finally:
-            await pubsub.unsubscribe(result_queue)
-            await pubsub.close()
+            future.cancel()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : pool.py
+@Author  : yintian
+@Date    : 2026/10/18 15:40
+@Software: PyCharm
+@Desc    : 进程内共享的 redis 连接池
+"""
+import asyncio
+import weakref
+
+from redis.asyncio import Redis, BlockingConnectionPool  # noqa
+from redis.asyncio.connection import parse_url  # noqa
+
+from ytools.arq import setting
+
+# 连接池与创建时的事件循环绑定, 按事件循环分别登记: {loop: {连接参数: 连接池}}
+POOLS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, BlockingConnectionPool]]" = weakref.WeakKeyDictionary()
+
+
+def make_key(**kwargs) -> tuple:
+    return tuple(sorted((k, repr(v)) for k, v in kwargs.items() if v is not None))
+
+
+def get_pool(url: str = None, max_connections: int = None, health_check_interval: int = None, **kwargs) -> BlockingConnectionPool:
+    """
+    按连接参数取得共享连接池, 相同参数的 Client / Agent / 结果订阅共用同一个池
+
+    连接数达到 max_connections 后新的请求会等待空闲连接(最多 REDIS_POOL_TIMEOUT 秒), 而不是继续建立连接
+
+    :param url: redis 连接地址, 为空时使用 kwargs 中的 host / port / db 等参数
+    :param max_connections: 最大连接数, 默认 REDIS_MAX_CONNECTIONS
+    :param health_check_interval: 连接空闲超过该秒数后, 使用前先 PING 检查
+    """
+    # 地址与 host / port 等参数写法不同但指向同一个库时共用连接池
+    options = {
+        "db": 0,
+        **(parse_url(url) if url else {}),
+        "max_connections": max_connections or setting.REDIS_MAX_CONNECTIONS,
+        "health_check_interval": setting.REDIS_HEALTH_CHECK_INTERVAL if health_check_interval is None else health_check_interval,
+        "timeout": setting.REDIS_POOL_TIMEOUT,
+        **kwargs,
+    }
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # 事件循环外创建的连接池无法确定归属, 不共享
+        return BlockingConnectionPool(**options)
+    pools = POOLS.setdefault(loop, {})
+    key = make_key(**options)
+    if key not in pools:
+        pools[key] = BlockingConnectionPool(**options)
+    return pools[key]
+
+
+def get_redis(url: str = None, **kwargs) -> Redis:
+    """使用共享连接池的 Redis 客户端, 参数见 get_pool"""
+    return Redis(connection_pool=get_pool(url, **kwargs))
+
+
+def get_name(pool) -> str:
+    kwargs = getattr(pool, "connection_kwargs", {})
+    if path := kwargs.get("path"):
+        return f"unix://{path}/{kwargs.get('db', 0)}"
+    return f"{kwargs.get('host', 'localhost')}:{kwargs.get('port', 6379)}/{kwargs.get('db', 0)}"
+
+
+def get_stats(pool) -> dict:
+    """连接池使用情况: 最大连接数、已建立连接数、使用中连接数"""
+    in_use = len(getattr(pool, "_in_use_connections", ()))
+    available = len(getattr(pool, "_available_connections", ()))
+    return {
+        "max_connections": pool.max_connections,
+        "created": in_use + available,
+        "in_use": in_use,
+    }
+
+
+def pool_stats() -> list[dict]:
+    """当前事件循环中所有共享连接池的使用情况"""
+    return [
+        {"pool": get_name(pool), **get_stats(pool)}
+        for pool in POOLS.get(asyncio.get_running_loop(), {}).values()
+    ]
+
+
+if __name__ == '__main__':
+    pass
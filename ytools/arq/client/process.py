@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : process.py
+@Author  : yintian
+@Date    : 2026/10/18 11:50
+@Software: PyCharm
+@Desc    : 进程池执行模式下在子进程中运行的函数
+"""
+from types import ModuleType
+
+from ytools.utils import magic
+
+
+def warmup(hooks=None):
+    """
+    子进程初始化: 预先导入模块或执行预热函数
+
+    :param hooks: 模块路径 / 对象路径 / 可调用对象, 加载结果为非模块的可调用对象时会被调用
+    """
+    for hook in hooks or ():
+        obj = magic.load_object(hook) if isinstance(hook, str) else hook
+        if callable(obj) and not isinstance(obj, ModuleType):
+            obj()
+
+
+def call(func, args=(), kwargs=None):
+    """子进程中按签名补齐参数后调用"""
+    return magic.prepare(func, *args, **(kwargs or {}))()
+
+
+if __name__ == '__main__':
+    pass
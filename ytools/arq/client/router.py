@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : router.py
+@Author  : yintian
+@Date    : 2026/10/18 10:40
+@Software: PyCharm
+@Desc    : 结果分发, 每个 client 共用一个模式订阅
+"""
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+from functools import partial
+from typing import Iterable
+
+from ytools.arq import setting
+
+
+class ResultRouter:
+    """
+    订阅 `<result_queue>:*`, 按 task_id 把结果分发给等待中的 future
+
+    没有等待者的结果会短暂缓存, 之后再等待时直接返回; 模式订阅会收到所有生产者的结果,
+    只缓存本进程投放(expect)或等待过的任务, 其他结果直接丢弃
+    """
+
+    # 按连接池共享: {连接池: {订阅模式: ResultRouter}}
+    routers: "weakref.WeakKeyDictionary[object, dict[str, ResultRouter]]" = weakref.WeakKeyDictionary()
+
+    def __init__(self, client, buffer_time: float = None, buffer_size: int = None, buffer_bytes: int = None):
+        self.client = client
+        self.pattern = client.get_queue("*", base=client.result_queue)
+        self.prefix = client.get_queue("", base=client.result_queue)
+        self.buffer_time = buffer_time or setting.RESULT_BUFFER_TIME
+        self.buffer_size = buffer_size or setting.RESULT_BUFFER_SIZE
+        self.buffer_bytes = buffer_bytes or setting.RESULT_BUFFER_BYTES
+        self.waiters: dict[str, list[asyncio.Future]] = {}
+        self.buffer: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.buffered = 0
+        # 等待结果的任务 id 及登记时间, 收到结果或超过 EXPIRE_TIME + buffer_time 后移除
+        self.expected: OrderedDict[str, float] = OrderedDict()
+        self.pubsub = None
+        self.listener: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def shared(cls, client) -> "ResultRouter":
+        """同一连接池上订阅同一结果队列的客户端共用一个 router, 只占用一个 pubsub 连接"""
+        routers = cls.routers.setdefault(client.redis.connection_pool, {})
+        pattern = client.get_queue("*", base=client.result_queue)
+        if pattern not in routers:
+            routers[pattern] = cls(client)
+        return routers[pattern]
+
+    async def start(self):
+        async with self._lock:
+            if self.listener and not self.listener.done():
+                return
+            self.pubsub = self.client.redis.pubsub()
+            await self.pubsub.psubscribe(self.pattern)
+            self.listener = asyncio.create_task(self.listen())
+
+    async def close(self):
+        if self.listener:
+            self.listener.cancel()
+            self.listener = None
+        if self.pubsub:
+            await self.pubsub.punsubscribe(self.pattern)
+            await self.pubsub.close()
+            self.pubsub = None
+        for futures in self.waiters.values():
+            for future in futures:
+                future.cancel()
+        self.waiters.clear()
+        self.buffer.clear()
+        self.buffered = 0
+        self.expected.clear()
+
+    async def listen(self):
+        while True:
+            try:
+                async for msg in self.pubsub.listen():
+                    if msg["type"] != "pmessage":
+                        continue
+                    channel = msg["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode(setting.DEFAULT_ENCODING)
+                    self.dispatch(channel[len(self.prefix):], msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # pubsub 重连时会自动重新订阅
+                self.client.log(f"结果订阅异常: {type(e).__name__}: {e}", level="error")
+                await asyncio.sleep(setting.INTERVAL)
+
+    def expect(self, task_ids: Iterable[str]):
+        """登记本进程投放的任务, 结果先于等待到达时缓存; 未建立订阅时无需登记"""
+        if not self.listener:
+            return
+        now = time.monotonic()
+        for task_id in task_ids:
+            self.expected[task_id] = now
+            self.expected.move_to_end(task_id)
+
+    def dispatch(self, task_id: str, data):
+        futures = [future for future in self.waiters.pop(task_id, []) if not future.done()]
+        for future in futures:
+            future.set_result(data)
+        if self.expected.pop(task_id, None) is not None and not futures and task_id not in self.buffer:
+            self.buffer[task_id] = (time.monotonic(), data)
+            self.buffered += len(data)
+        self.trim()
+
+    def trim(self):
+        now = time.monotonic()
+        deadline = now - self.buffer_time
+        while self.buffer:
+            task_id, (ts, data) = next(iter(self.buffer.items()))
+            if ts >= deadline and len(self.buffer) <= self.buffer_size and self.buffered <= self.buffer_bytes:
+                break
+            self.buffer.pop(task_id)
+            self.buffered -= len(data)
+        deadline = now - setting.EXPIRE_TIME - self.buffer_time
+        while self.expected and next(iter(self.expected.values())) < deadline:
+            self.expected.popitem(last=False)
+
+    async def wait(self, task_id: str) -> asyncio.Future:
+        """返回一个 future, 收到该任务结果时完成; 取消 future 即取消等待"""
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.trim()
+        if task_id in self.buffer:
+            _, data = self.buffer.pop(task_id)
+            self.buffered -= len(data)
+            future.set_result(data)
+            return future
+        # 等待取消(如超时)后才到达的结果仍会缓存, 可以再次等待
+        self.expect([task_id])
+        self.waiters.setdefault(task_id, []).append(future)
+        future.add_done_callback(partial(self.discard, task_id))
+        return future
+
+    def discard(self, task_id: str, future: asyncio.Future):
+        futures = self.waiters.get(task_id)
+        if futures and future in futures:
+            futures.remove(future)
+            futures or self.waiters.pop(task_id, None)
+
+
+if __name__ == '__main__':
+    pass
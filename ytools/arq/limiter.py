@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : limiter.py
+@Author  : yintian
+@Date    : 2026/10/18 16:20
+@Software: PyCharm
+@Desc    : 基于 redis 令牌桶的全局限速
+"""
+import asyncio
+import time
+
+from ytools.arq import setting, scripts
+
+
+class RateLimiter:
+    """
+    多个 Agent 共用的令牌桶限速, 每执行一个任务消耗一个令牌
+
+    每次从 redis 借用一批令牌在本地消耗, 减少往返; 借到的令牌只在对应的时间窗口内有效,
+    闲置后不会集中使用, 全局速率不会超过 rate
+    """
+
+    def __init__(self, client, key: str, rate: float, capacity: float = None, batch: int = None):
+        """
+        :param client: BaseClient, 用于执行 lua 脚本
+        :param key: 令牌桶 key, key 相同的限速器共享速率
+        :param rate: 每秒令牌数
+        :param capacity: 桶容量(允许的突发量), 默认为 1 秒的令牌数
+        :param batch: 每次借用的令牌数, 默认为 RATE_BATCH_WINDOW 秒的令牌数
+        """
+        self.client = client
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.batch = batch or max(1, int(rate * setting.RATE_BATCH_WINDOW))
+        self.tokens = 0
+        self.expire_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def take(self, count: int) -> tuple[int, int]:
+        """从令牌桶借用至多 count 个令牌, 返回 (借到的数量, 需等待的毫秒数)"""
+        granted, wait = await self.client.get_script(scripts.TAKE_TOKENS)(
+            keys=[self.key],
+            args=[self.rate, self.capacity, count]
+        )
+        return int(granted), int(wait)
+
+    async def acquire(self):
+        """取得一个令牌, 没有令牌时等待"""
+        async with self._lock:
+            while True:
+                if self.tokens and time.monotonic() < self.expire_at:
+                    self.tokens -= 1
+                    return
+                granted, wait = await self.take(self.batch)
+                if granted:
+                    self.tokens = granted - 1
+                    self.expire_at = time.monotonic() + max(granted / self.rate, setting.RATE_BATCH_WINDOW)
+                    return
+                await asyncio.sleep(wait / 1000)
+
+    @classmethod
+    def make(cls, client, queue_name: str, limit: "float | dict") -> "RateLimiter":
+        """
+        :param limit: 每秒次数, 或 {"rate": ..., "capacity": ..., "batch": ..., "key": ...}, key 默认为队列名
+        """
+        if not isinstance(limit, dict):
+            limit = {"rate": limit}
+        limit = dict(limit)
+        key = client.get_queue("ratelimit", limit.pop("key", None) or queue_name, base=setting.DEFAULT_QUEUE_NAME)
+        return cls(client, key, **limit)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.key} rate={self.rate} capacity={self.capacity} batch={self.batch}>"
+
+
+if __name__ == '__main__':
+    pass
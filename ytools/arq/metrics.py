@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : metrics.py
+@Author  : yintian
+@Date    : 2026/10/18 14:30
+@Software: PyCharm
+@Desc    : 按队列统计的进程内指标, 可输出为 prometheus 文本或写入心跳
+"""
+import asyncio
+import bisect
+import math
+import time
+from typing import Iterable, Callable
+
+from ytools.arq import setting
+
+# 直方图: 排队等待、执行、发布结果耗时(秒)
+HISTOGRAMS = {
+    "queue_wait": "任务从投放(或到期)到开始执行的等待时间",
+    "exec_time": "任务执行耗时",
+    "publish_time": "发布结果耗时",
+}
+# 计数器
+COUNTERS = {
+    "failures": "执行失败的任务数",
+    "retries": "重新投放重试的任务数",
+    "timeouts": "执行超时的任务数",
+}
+
+
+class Histogram:
+    """固定分桶的直方图, 每个桶只记录落入的次数, 分位数按桶内线性插值估算"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Iterable[float] = None):
+        self.bounds = list(bounds or setting.METRICS_BUCKETS)
+        # 最后一个桶为 +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            if total + count >= rank and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0
+                return lower + (self.bounds[i] - lower) * (rank - total) / count
+            total += count
+        return self.bounds[-1]
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data: dict, bounds: Iterable[float] = None):
+        histogram = cls(bounds)
+        histogram.merge(data)
+        return histogram
+
+    def merge(self, data: dict):
+        """合并其他进程上报的同分桶直方图"""
+        for i, count in enumerate(data.get("counts", [])[:len(self.counts)]):
+            self.counts[i] += count
+        self.sum += data.get("sum", 0)
+        self.count += data.get("count", 0)
+
+
+class RateCounter:
+    """最近 window 秒内的计数, 按秒分桶, 过期的桶在下次写入时复用"""
+
+    __slots__ = ("window", "buckets", "seconds")
+
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.buckets = [0] * window
+        self.seconds = [0] * window
+
+    def increment(self, step: int = 1):
+        now = int(time.monotonic())
+        i = now % self.window
+        if self.seconds[i] != now:
+            self.seconds[i] = now
+            self.buckets[i] = 0
+        self.buckets[i] += step
+
+    def count(self) -> int:
+        now = int(time.monotonic())
+        return sum(count for count, second in zip(self.buckets, self.seconds) if now - second < self.window)
+
+
+class Metrics:
+    """
+    按队列统计的指标
+
+    只在事件循环内更新, 无需加锁; to_dict 的结果可跨进程合并, 用于心跳与 supervisor 汇总
+    """
+
+    def __init__(self, bounds: Iterable[float] = None):
+        self.bounds = list(bounds or setting.METRICS_BUCKETS)
+        self.histograms: dict[str, dict[str, Histogram]] = {}
+        self.counters: dict[str, dict[str, int]] = {}
+
+    def observe(self, queue_name: str, name: str, value: float):
+        queue = self.histograms.setdefault(queue_name, {})
+        if name not in queue:
+            queue[name] = Histogram(self.bounds)
+        queue[name].observe(value)
+
+    def increment(self, queue_name: str, name: str, step: int = 1):
+        queue = self.counters.setdefault(queue_name, {})
+        queue[name] = queue.get(name, 0) + step
+
+    def to_dict(self):
+        return {
+            queue_name: {
+                **{name: histogram.to_dict() for name, histogram in self.histograms.get(queue_name, {}).items()},
+                **self.counters.get(queue_name, {}),
+            }
+            for queue_name in {*self.histograms, *self.counters}
+        }
+
+    def merge(self, data: dict):
+        for queue_name, values in (data or {}).items():
+            for name, value in values.items():
+                if isinstance(value, dict):
+                    queue = self.histograms.setdefault(queue_name, {})
+                    if name not in queue:
+                        queue[name] = Histogram(self.bounds)
+                    queue[name].merge(value)
+                else:
+                    self.increment(queue_name, name, value)
+
+    @classmethod
+    def from_dicts(cls, items: Iterable[dict]):
+        metrics = cls()
+        for data in items:
+            metrics.merge(data)
+        return metrics
+
+    def render(self, prefix="arq") -> str:
+        """输出 prometheus 文本格式"""
+        lines = []
+        for name, desc in HISTOGRAMS.items():
+            metric = f"{prefix}_{name}_seconds"
+            lines += [f"# HELP {metric} {desc}", f"# TYPE {metric} histogram"]
+            for queue_name, histograms in sorted(self.histograms.items()):
+                if not (histogram := histograms.get(name)):
+                    continue
+                total = 0
+                for bound, count in zip([*histogram.bounds, math.inf], histogram.counts):
+                    total += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f'{metric}_bucket{{queue="{queue_name}",le="{le}"}} {total}')
+                lines.append(f'{metric}_sum{{queue="{queue_name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{queue="{queue_name}"}} {histogram.count}')
+        for name, desc in COUNTERS.items():
+            metric = f"{prefix}_{name}_total"
+            lines += [f"# HELP {metric} {desc}", f"# TYPE {metric} counter"]
+            for queue_name, counters in sorted(self.counters.items()):
+                lines.append(f'{metric}{{queue="{queue_name}"}} {counters.get(name, 0)}')
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int, host: str = "127.0.0.1"):
+        return await serve(self.render, port, host)
+
+
+async def serve(render: Callable[[], str], port: int, host: str = "127.0.0.1"):
+    """启动只返回指标文本的 http 服务, 供 prometheus 抓取"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : retry.py
+@Author  : yintian
+@Date    : 2026/10/18 13:40
+@Software: PyCharm
+@Desc    : 任务重试策略
+"""
+import random
+
+
+class RetryPolicy:
+    """
+    重试策略: 指数退避 + 抖动
+
+    第 n 次失败后的等待时间为 min(max_backoff, backoff * factor ** (n - 1)),
+    开启 jitter 时在 [delay / 2, delay] 之间随机
+    """
+
+    def __init__(
+            self,
+            max_attempts: int = 3,
+            backoff: float = 1,
+            factor: float = 2,
+            max_backoff: float = 300,
+            jitter: bool = True,
+            retry_on: tuple[type[BaseException] | str, ...] = (Exception,),
+    ):
+        """
+        :param max_attempts: 最多执行次数(含首次)
+        :param backoff: 首次重试等待秒数
+        :param factor: 退避倍数
+        :param max_backoff: 最大等待秒数
+        :param jitter: 是否添加随机抖动
+        :param retry_on: 可重试的异常类型, 也可以是类名或 模块.类名
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        for kind in self.retry_on:
+            if isinstance(kind, type):
+                if isinstance(exc, kind):
+                    return True
+            elif any(kind in (cls.__name__, f"{cls.__module__}.{cls.__qualname__}") for cls in type(exc).__mro__):
+                return True
+        return False
+
+    def should_retry(self, attempts: int, exc: BaseException) -> bool:
+        return attempts < self.max_attempts and self.is_retryable(exc)
+
+    def countdown(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.backoff * self.factor ** max(attempts - 1, 0))
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def to_dict(self):
+        return {
+            "max_attempts": self.max_attempts,
+            "backoff": self.backoff,
+            "factor": self.factor,
+            "max_backoff": self.max_backoff,
+            "jitter": self.jitter,
+            "retry_on": [kind if isinstance(kind, str) else f"{kind.__module__}.{kind.__qualname__}" for kind in self.retry_on],
+        }
+
+    @classmethod
+    def make(cls, policy: "RetryPolicy | dict | int | None"):
+        """RetryPolicy / dict / 最大次数 统一转为 RetryPolicy"""
+        if policy is None or isinstance(policy, cls):
+            return policy
+        if isinstance(policy, int):
+            return cls(max_attempts=policy)
+        return cls(**policy)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.to_dict()}>"
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : scripts.py
+@Author  : yintian
+@Date    : 2026/10/18 10:12
+@Software: PyCharm
+@Desc    : arq 使用的 lua 脚本
+"""
+
+# 原子出队: 弹出分数最小的任务 id, 读取其数据; 开启租约时写入 processing 并保留数据, 否则删除数据
+# 出队前无法得知任务 id, 数据 key 只能由前缀拼出而不在 KEYS 中: Redis Cluster 下队列名需带 hash tag(如 {jobs}) 使队列的所有 key
+# 落在同一个 slot, 按 key 授权的 ACL 需放行 <队列名>:*; 不满足时使用 Agent(atomic=False)
+# KEYS[1]: 任务队列; KEYS[2]: processing 队列
+# ARGV[1]: 出队数量; ARGV[2]: 数据 key 前缀; ARGV[3]: 租约到期时间戳, 为 0 时不写租约; ARGV[4]: 保留数据的过期时间(秒)
+# ARGV[5...]: 已出队(如 BZPOPMIN)但还未取数据的任务 id
+# 返回: {task_id, data, ...}, 数据不存在时为 nil
+POP_TASKS = """
+local lease = tonumber(ARGV[3])
+local task_ids = {}
+for i = 5, #ARGV do
+    table.insert(task_ids, ARGV[i])
+end
+local count = tonumber(ARGV[1])
+if count > 0 then
+    local popped = redis.call('ZRANGE', KEYS[1], 0, count - 1)
+    if #popped > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #popped - 1)
+        for _, task_id in ipairs(popped) do
+            table.insert(task_ids, task_id)
+        end
+    end
+end
+local result = {}
+for _, task_id in ipairs(task_ids) do
+    local data_key = ARGV[2] .. task_id
+    local data = redis.call('GET', data_key)
+    table.insert(result, task_id)
+    table.insert(result, data)
+    if lease > 0 and data then
+        redis.call('ZADD', KEYS[2], lease, task_id)
+        redis.call('EXPIRE', data_key, ARGV[4])
+    else
+        redis.call('DEL', data_key)
+    end
+end
+return result
+"""
+
+# 移动到期的延迟任务至就绪队列, 到期的任务 id 由调用方先取出, 用到的 key 全部通过 KEYS 传入
+# KEYS[1]: 延迟队列; KEYS[2]: 就绪队列(zset 或 stream); KEYS[3...]: 与任务 id 一一对应的数据 key, 只有 stream 后端需要
+# ARGV[1]: 当前时间戳; ARGV[2]: 后端 zset/stream; ARGV[3]: stream 最大长度, 为 0 时不裁剪; ARGV[4...]: 任务 id
+# zset 后端以分数 0 放入就绪队列, 到期任务优先执行; stream 后端把数据随条目写入并删除数据 key
+# 期间已被其他 Agent 移走或重新投放为未到期的任务跳过
+# 返回: 移动的任务数
+PROMOTE_TASKS = """
+local now = tonumber(ARGV[1])
+local maxlen = tonumber(ARGV[3]) or 0
+local count = 0
+for i = 4, #ARGV do
+    local task_id = ARGV[i]
+    local eta = redis.call('ZSCORE', KEYS[1], task_id)
+    if eta and tonumber(eta) <= now then
+        redis.call('ZREM', KEYS[1], task_id)
+        count = count + 1
+        if ARGV[2] == 'stream' then
+            local data_key = KEYS[i - 1]
+            local data = redis.call('GET', data_key)
+            if data then
+                if maxlen > 0 then
+                    redis.call('XADD', KEYS[2], 'MAXLEN', '~', maxlen, '*', 'task_id', task_id, 'data', data)
+                else
+                    redis.call('XADD', KEYS[2], '*', 'task_id', task_id, 'data', data)
+                end
+                redis.call('DEL', data_key)
+            end
+        else
+            redis.call('ZADD', KEYS[2], 0, task_id)
+        end
+    end
+end
+return count
+"""
+
+# 回收过期租约: 持有者已失联, 把任务重新放回就绪队列, 数据已不存在的直接丢弃; 过期的任务 id 由调用方先取出
+# KEYS[1]: processing 队列; KEYS[2]: 任务队列; KEYS[3...]: 与任务 id 一一对应的数据 key
+# ARGV[1]: 当前时间戳; ARGV[2...]: 任务 id
+# 期间已续约或已完成的任务跳过
+# 返回: 重新投放的任务数
+REAP_LEASES = """
+local now = tonumber(ARGV[1])
+local count = 0
+for i = 2, #ARGV do
+    local task_id = ARGV[i]
+    local deadline = redis.call('ZSCORE', KEYS[1], task_id)
+    if deadline and tonumber(deadline) <= now then
+        redis.call('ZREM', KEYS[1], task_id)
+        if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+            redis.call('ZADD', KEYS[2], 0, task_id)
+            count = count + 1
+        end
+    end
+end
+return count
+"""
+
+# 令牌桶限速, 时间取 redis 服务端时间, 多台机器共用同一个桶
+# KEYS[1]: 令牌桶 hash {tokens, ts}
+# ARGV[1]: 每秒产生的令牌数; ARGV[2]: 桶容量; ARGV[3]: 本次借用的令牌数
+# 返回: {借到的令牌数, 一个都没借到时需等待的毫秒数}
+TAKE_TOKENS = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+local wait = 0
+if granted == 0 then
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+return {granted, wait}
+"""
+
+if __name__ == '__main__':
+    pass
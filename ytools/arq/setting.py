@@ -14,10 +14,91 @@ ENCRYPT = False
 DEFAULT_ENCODING = "utf-8"
 # 轮询休眠
 INTERVAL = 0.01
+# 阻塞出队超时时间(秒), 为 0 时退化为轮询
+BLOCK_TIMEOUT = 1
+# 无人等待的结果缓存时间(秒)、数量与总字节数, 只缓存本进程投放或等待过的任务的结果
+RESULT_BUFFER_TIME = 60
+RESULT_BUFFER_SIZE = 10000
+RESULT_BUFFER_BYTES = 64 * 1024 * 1024
+# 队列后端: zset(有序集合 + 数据 key) / stream(Redis Streams + 消费组)
+BACKEND = "zset"
+# stream 消费组名称
+STREAM_GROUP = "ytools"
+# stream 近似最大长度, 为 None 时不裁剪; 已完成的条目确认后即删除, stream 中只剩未执行的任务,
+# 设置后是硬上限: 积压超出时最旧的未执行任务会被直接裁掉, 不会报错
+STREAM_MAXLEN = None
+# stream 未确认条目空闲超过该时间(毫秒)后可被其他消费者认领
+STREAM_CLAIM_IDLE = 60000
+# stream 认领检查间隔(秒)
+STREAM_CLAIM_INTERVAL = 30
+# 默认编解码器(raw/json/pickle/marshal/msgpack/orjson), 为 None 时沿用无头部的旧格式
+CODEC = None
+# 额外允许解码的编解码器, 默认只解码 raw / json 与自身的 CODEC; pickle / marshal 可还原任意对象, 只应在可信的队列中开启
+ACCEPT_CODECS = ()
+# 默认压缩算法(zlib/lzma/bz2), 为 None 时不压缩
+COMPRESS = None
+# 编码后数据不小于该字节数时才压缩
+COMPRESS_THRESHOLD = 1024
+# 进程池执行模式下子进程的启动方式
+PROCESS_START_METHOD = "spawn"
+# 心跳上报间隔(秒)
+HEARTBEAT_INTERVAL = 5
+# 多进程 supervisor 检查子进程的间隔(秒)
+SUPERVISOR_INTERVAL = 1
+# 子进程退出后的重启退避(秒): 连续第 n 次启动后很快退出时等待 min(SUPERVISOR_MAX_BACKOFF, SUPERVISOR_BACKOFF * 2 ** (n - 1))
+SUPERVISOR_BACKOFF = 1
+SUPERVISOR_MAX_BACKOFF = 60
+# 启动后该秒数内退出视为启动失败, 同一子进程连续失败 SUPERVISOR_MAX_CRASHES 次后 supervisor 报错退出
+SUPERVISOR_CRASH_WINDOW = 10
+SUPERVISOR_MAX_CRASHES = 5
+# 延迟任务到期检查间隔(秒)
+DELAY_INTERVAL = 1
+# 每次 lua 调用最多移动的到期任务数
+DELAY_BATCH = 1000
+# 任务重试次数、单任务重试策略 key 的过期时间(秒)
+RETRY_EXPIRE = 86400
+# 任务租约时长(秒), 执行期间每 1/3 租约续约一次, 超时未续约的任务会被重新投放; 为 0 时不记录租约
+# stream 后端另外至少每 STREAM_CLAIM_IDLE / 3 续约一次, 为 0 时也会续约
+LEASE_TIME = 60
+# 每次回收过期租约的最大数量
+LEASE_BATCH = 1000
+# 去重 key 的有效期(秒), 期间相同 dedup_key 的任务不会重复投放
+DEDUP_TTL = 3600
+# 结果缓存的默认有效期(秒)
+CACHE_TTL = 300
+# 耗时直方图的分桶上界(秒)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 共享连接池的最大连接数, 达到后等待空闲连接
+REDIS_MAX_CONNECTIONS = 64
+# 等待空闲连接的超时时间(秒)
+REDIS_POOL_TIMEOUT = 20
+# 连接空闲超过该秒数后, 使用前先 PING 检查, 为 0 时不检查
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# 生产端队列深度缓存的刷新间隔(秒), 队列已满、有投放在等待时从 DEPTH_MIN_INTERVAL 起逐步放宽到该值
+DEPTH_REFRESH_INTERVAL = 1
+DEPTH_MIN_INTERVAL = 0.05
+# 限速器每次从 redis 借用多少秒的令牌
+RATE_BATCH_WINDOW = 0.1
+# 编码后数据不小于该字节数时写入外置存储, 队列与 pubsub 中只传递引用; 为 0 时不外置
+OFFLOAD_THRESHOLD = 0
+# 外置存储: redis(分块写入 redis list) 或本地/共享目录路径
+OFFLOAD_STORE = "redis"
+# 外置数据的分块大小(字节)
+OFFLOAD_CHUNK_SIZE = 512 * 1024
+# 外置结果的有效期(秒), 任务数据与数据 key 同时过期
+OFFLOAD_EXPIRE = 3600
+# 目录存储清理过期文件的间隔(秒)
+OFFLOAD_CLEAN_INTERVAL = 60
+# 平滑停止时等待执行中任务完成的最长时间(秒), 超时后未完成的任务放回队列
+DRAIN_TIMEOUT = 30
 # 传入的是否是可序列化数据
 OBJ_DATA = False
 # key 超时删除时间
 EXPIRE_TIME = 300
+# 批量投放时每批任务数
+BATCH_SIZE = 500
+# 自动合批的等待窗口(秒)
+BATCH_WINDOW = 0.005
 
 if __name__ == '__main__':
     pass
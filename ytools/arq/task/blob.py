@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : blob.py
+@Author  : yintian
+@Date    : 2026/10/18 17:10
+@Software: PyCharm
+@Desc    : 大数据外置存储, 超过阈值的任务数据/结果写入外部存储, 队列与 pubsub 中只传递引用
+"""
+import asyncio
+import contextlib
+import os
+import time
+from typing import AsyncIterator
+from uuid import uuid4
+
+from ytools.arq import setting
+from ytools.arq.task import codec
+
+
+class BlobStore:
+    """外置存储基类, 数据按 key 存取, 过期后自动清理"""
+
+    name: str = None
+
+    async def put(self, data: bytes, ttl: int) -> dict:
+        """写入数据, 返回可据此读取的引用"""
+        raise NotImplementedError
+
+    async def iter(self, ref: dict) -> AsyncIterator[bytes]:
+        """按块读取数据"""
+        raise NotImplementedError
+        yield  # noqa
+
+    async def touch(self, ref: dict, ttl: int) -> bool:
+        """顺延过期时间, 数据已不存在时返回 False"""
+        raise NotImplementedError
+
+    async def delete(self, ref: dict):
+        raise NotImplementedError
+
+    async def get(self, ref: dict) -> bytes:
+        chunks = [chunk async for chunk in self.iter(ref)]
+        data = b"".join(chunks)
+        if len(data) != ref["size"]:
+            raise ValueError(f"外置数据已过期或不完整: {ref['key']}")
+        return data
+
+
+class RedisBlobStore(BlobStore):
+    """分块写入 redis list, 单个 value 不超过 chunk_size, 读取时逐块获取"""
+
+    name = "redis"
+
+    def __init__(self, redis, prefix: str, chunk_size: int = None):
+        self.redis = redis
+        self.prefix = prefix
+        self.chunk_size = chunk_size or setting.OFFLOAD_CHUNK_SIZE
+
+    async def put(self, data: bytes, ttl: int) -> dict:
+        key = f"{self.prefix}{uuid4().hex}"
+        view = memoryview(data)
+        chunks = [bytes(view[i:i + self.chunk_size]) for i in range(0, len(data), self.chunk_size)]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await pipe.rpush(key, *chunks)
+            await pipe.expire(key, ttl)
+            await pipe.execute()
+        return {"store": self.name, "key": key, "size": len(data), "chunks": len(chunks)}
+
+    async def iter(self, ref: dict) -> AsyncIterator[bytes]:
+        for i in range(ref["chunks"]):
+            chunk = await self.redis.lindex(ref["key"], i)
+            if chunk is None:
+                raise ValueError(f"外置数据已过期或不完整: {ref['key']}")
+            yield chunk
+
+    async def touch(self, ref: dict, ttl: int) -> bool:
+        return bool(await self.redis.expire(ref["key"], ttl))
+
+    async def delete(self, ref: dict):
+        await self.redis.delete(ref["key"])
+
+
+class FileBlobStore(BlobStore):
+    """写入本地或共享目录, 文件修改时间记为过期时间, 写入时顺带清理过期文件"""
+
+    name = "file"
+
+    def __init__(self, path: str, chunk_size: int = None):
+        self.path = os.path.abspath(path)
+        self.chunk_size = chunk_size or setting.OFFLOAD_CHUNK_SIZE
+        self.cleaned_at = 0.0
+        os.makedirs(self.path, exist_ok=True)
+
+    def write(self, key: str, data: bytes, ttl: int):
+        path = os.path.join(self.path, key)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        expire_at = time.time() + ttl
+        os.utime(f"{path}.tmp", (expire_at, expire_at))
+        os.replace(f"{path}.tmp", path)
+
+    def clean(self):
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    # 临时文件在写入完成前也记录了较早的修改时间, 多留一个周期
+                    if entry.stat().st_mtime < now - (setting.OFFLOAD_CLEAN_INTERVAL if entry.name.endswith(".tmp") else 0):
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    async def put(self, data: bytes, ttl: int) -> dict:
+        key = uuid4().hex
+        await asyncio.to_thread(self.write, key, data, ttl)
+        if time.monotonic() - self.cleaned_at > setting.OFFLOAD_CLEAN_INTERVAL:
+            self.cleaned_at = time.monotonic()
+            await asyncio.to_thread(self.clean)
+        return {"store": self.name, "key": key, "size": len(data), "path": self.path}
+
+    async def iter(self, ref: dict) -> AsyncIterator[bytes]:
+        path = os.path.join(ref.get("path") or self.path, ref["key"])
+        try:
+            f = await asyncio.to_thread(open, path, "rb")
+        except FileNotFoundError:
+            raise ValueError(f"外置数据已过期或不完整: {ref['key']}")
+        try:
+            while chunk := await asyncio.to_thread(f.read, self.chunk_size):
+                yield chunk
+        finally:
+            f.close()
+
+    async def touch(self, ref: dict, ttl: int) -> bool:
+        expire_at = time.time() + ttl
+        path = os.path.join(ref.get("path") or self.path, ref["key"])
+        try:
+            await asyncio.to_thread(os.utime, path, (expire_at, expire_at))
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def delete(self, ref: dict):
+        path = os.path.join(ref.get("path") or self.path, ref["key"])
+        with contextlib.suppress(FileNotFoundError):
+            await asyncio.to_thread(os.remove, path)
+
+
+def is_ref(data) -> bool:
+    return codec.is_packed(data) and bool(data[3] & codec.BLOB_FLAG)
+
+
+def make_ref(ref: dict, flags: int = 0) -> bytes:
+    """:param flags: 需要保留的原数据标记位, 如 RETRY_FLAG"""
+    return codec.pack(ref, "json", flags=codec.BLOB_FLAG | flags)
+
+
+def load_ref(data: bytes) -> dict:
+    return codec.get_codec("json").loads(memoryview(data)[codec.header_size(data):])
+
+
+if __name__ == '__main__':
+    pass
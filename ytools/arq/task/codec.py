@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : codec.py
+@Author  : yintian
+@Date    : 2026/10/18 11:05
+@Software: PyCharm
+@Desc    : 任务数据编解码与压缩
+"""
+import bz2
+import json
+import lzma
+import marshal
+import pickle
+import struct
+import zlib
+from typing import Callable, Any, Iterable
+
+from ytools.arq import setting
+from ytools.utils.magic import json_or_eval
+
+# 头部: 2 字节魔数 + 1 字节编解码器 + 1 字节标记位(低 4 位为压缩算法编号, 0x10 表示数据为外置存储的引用, 0x20 表示投放时附带了重试策略,
+# 0x40 表示其后跟有 8 字节的投放时间戳)
+# 0xA7 不能作为 utf-8 首字节, base64 输出也不会包含, 因此不会与旧格式数据混淆
+MAGIC = b"\xa7y"
+HEADER_SIZE = 4
+COMPRESS_MASK = 0x0F
+# 未显式允许时可解码的编解码器, 不会还原任意对象
+SAFE_CODECS = ("raw", "json")
+BLOB_FLAG = 0x10
+RETRY_FLAG = 0x20
+TIME_FLAG = 0x40
+TIME_FORMAT = struct.Struct(">d")
+
+
+class Codec:
+    def __init__(self, name: str, code: int, dumps: Callable[[Any], bytes], loads: Callable[[memoryview], Any]):
+        self.name = name
+        self.code = code
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+CODECS: dict[str, Codec] = {}
+CODES: dict[int, Codec] = {}
+
+
+def register_codec(name: str, code: int, dumps: Callable[[Any], bytes], loads: Callable[[memoryview], Any]):
+    """
+    注册编解码器
+
+    :param name: 名称, Client/Agent 通过 codec=name 选择
+    :param code: 写入头部的编号, 0-255, 生产者与消费者需一致
+    :param dumps: 对象 -> bytes
+    :param loads: memoryview -> 对象
+    """
+    if code in CODES and CODES[code].name != name:
+        raise ValueError(f"编解码器编号 {code} 已被 {CODES[code].name} 使用")
+    codec = Codec(name, code, dumps, loads)
+    CODECS[name] = CODES[code] = codec
+    return codec
+
+
+def get_codec(codec: str | Codec) -> Codec:
+    if isinstance(codec, Codec):
+        return codec
+    if codec not in CODECS:
+        raise ValueError(f"未注册的编解码器: {codec}, 可选: {list(CODECS)}")
+    return CODECS[codec]
+
+
+def raw_dumps(data) -> bytes:
+    """与旧格式一致: str/bytes 原样, 其他对象转 json"""
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode(setting.DEFAULT_ENCODING)
+    return json.dumps(data, ensure_ascii=False, default=str).encode(setting.DEFAULT_ENCODING)
+
+
+def raw_loads(data) -> bytes:
+    data = bytes(data)
+    if setting.OBJ_DATA:
+        return json_or_eval(data.decode(setting.DEFAULT_ENCODING))
+    return data
+
+
+register_codec("raw", 0, raw_dumps, raw_loads)
+register_codec("json", 1, lambda data: json.dumps(data, ensure_ascii=False, default=str).encode(setting.DEFAULT_ENCODING), lambda data: json.loads(bytes(data)))
+# pickle / marshal 可还原任意对象, 只应在可信的队列中使用
+register_codec("pickle", 2, lambda data: pickle.dumps(data, protocol=5), pickle.loads)
+register_codec("marshal", 3, marshal.dumps, marshal.loads)
+
+try:
+    import msgpack  # noqa
+
+    register_codec("msgpack", 4, lambda data: msgpack.packb(data, use_bin_type=True, default=str), lambda data: msgpack.unpackb(data, raw=False))
+except ImportError:
+    pass
+
+try:
+    import orjson  # noqa
+
+    register_codec("orjson", 5, lambda data: orjson.dumps(data, default=str), orjson.loads)
+except ImportError:
+    pass
+
+
+class Compressor:
+    def __init__(self, name: str, code: int, compress: Callable[[bytes], bytes], decompress: Callable[[memoryview], bytes]):
+        self.name = name
+        self.code = code
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+COMPRESSORS: dict[str, Compressor] = {}
+COMPRESS_CODES: dict[int, Compressor] = {}
+
+
+def register_compressor(name: str, code: int, compress: Callable[[bytes], bytes], decompress: Callable[[memoryview], bytes]):
+    """
+    注册压缩算法
+
+    :param name: 名称, Client/Agent 通过 compress=name 选择
+    :param code: 写入头部标记位的编号, 1-15
+    :param compress: bytes -> bytes
+    :param decompress: memoryview -> bytes
+    """
+    if not 0 < code <= COMPRESS_MASK:
+        raise ValueError(f"压缩算法编号应在 1-{COMPRESS_MASK} 之间: {code}")
+    if code in COMPRESS_CODES and COMPRESS_CODES[code].name != name:
+        raise ValueError(f"压缩算法编号 {code} 已被 {COMPRESS_CODES[code].name} 使用")
+    compressor = Compressor(name, code, compress, decompress)
+    COMPRESSORS[name] = COMPRESS_CODES[code] = compressor
+    return compressor
+
+
+def get_compressor(compressor: str | Compressor) -> Compressor:
+    if isinstance(compressor, Compressor):
+        return compressor
+    if compressor not in COMPRESSORS:
+        raise ValueError(f"未注册的压缩算法: {compressor}, 可选: {list(COMPRESSORS)}")
+    return COMPRESSORS[compressor]
+
+
+register_compressor("zlib", 1, zlib.compress, zlib.decompress)
+register_compressor("lzma", 2, lzma.compress, lzma.decompress)
+register_compressor("bz2", 3, bz2.compress, bz2.decompress)
+
+
+def is_packed(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == MAGIC
+
+
+def get_flags(data) -> int:
+    return data[3] if is_packed(data) else 0
+
+
+def header_size(data) -> int:
+    """头部长度, 带投放时间戳时包含时间戳"""
+    return HEADER_SIZE + (TIME_FORMAT.size if get_flags(data) & TIME_FLAG else 0)
+
+
+def stamp(data: bytes, ts: float) -> bytes:
+    """在头部写入投放时间戳, 已有时覆盖; 没有头部(旧格式或已加密)的数据原样返回"""
+    if not is_packed(data):
+        return data
+    view = memoryview(data)
+    return b"".join((MAGIC, bytes((view[2], view[3] | TIME_FLAG)), TIME_FORMAT.pack(ts), view[header_size(data):]))
+
+
+def get_stamp(data) -> float | None:
+    """读取头部中的投放时间戳, 没有时返回 None"""
+    if get_flags(data) & TIME_FLAG:
+        return TIME_FORMAT.unpack_from(data, HEADER_SIZE)[0]
+    return None
+
+
+def pack(data, codec: str | Codec = "json", compressor: str | Compressor = None, threshold: int = 0, flags: int = 0) -> bytes:
+    """
+    编码数据并写入头部
+
+    :param data: 数据
+    :param codec: 编解码器
+    :param compressor: 压缩算法, 编码后长度不小于 threshold 时压缩
+    :param threshold: 压缩阈值(字节)
+    :param flags: 额外标记位
+    """
+    codec = get_codec(codec)
+    body = codec.dumps(data)
+    if compressor and len(body) >= threshold:
+        compressor = get_compressor(compressor)
+        body = compressor.compress(body)
+        flags |= compressor.code
+    return MAGIC + bytes((codec.code, flags)) + body
+
+
+def unpack(data: bytes, accept: Iterable[str] = None):
+    """
+    按头部解码数据
+
+    :param data: 数据
+    :param accept: 允许的编解码器, 默认只允许 SAFE_CODECS; 头部来自不可信的数据, pickle / marshal 需接收端显式允许
+    """
+    view = memoryview(data)
+    code, flags = view[2], view[3]
+    if flags & BLOB_FLAG:
+        raise ValueError("数据为外置存储的引用, 需先通过 client.resolve 读取")
+    if code not in CODES:
+        raise ValueError(f"未知的编解码器编号: {code}")
+    if CODES[code].name not in (SAFE_CODECS if accept is None else accept):
+        raise ValueError(f"拒绝解码: 编解码器 {CODES[code].name} 未被允许, 可通过 accept 参数或 setting.ACCEPT_CODECS 开启")
+    body = view[header_size(data):]
+    if compress_code := flags & COMPRESS_MASK:
+        if compress_code not in COMPRESS_CODES:
+            raise ValueError(f"未知的压缩算法编号: {compress_code}")
+        body = memoryview(COMPRESS_CODES[compress_code].decompress(body))
+    return CODES[code].loads(body)
+
+
+if __name__ == '__main__':
+    pass
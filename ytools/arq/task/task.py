@@ -15,7 +15,9 @@ from typing import Callable
 from uuid import uuid4
 
 from ytools.arq import setting
+from ytools.arq.task import codec, blob
 from ytools.utils import magic
+from ytools.utils.magic import empty
 from ytools.utils.encrypt import SaltBase64
 
 
@@ -23,9 +25,22 @@ class Task:
     _score = count()
     callback: Callable = None
     result: Future | None = None
+    queue_name: str | None = None
+    eta: float | None = None
+    # 从 redis 取出的原始数据, 重新投放时原样写回
+    raw: bytes | None = None
+    # 该任务的重试策略, 见 ytools.arq.retry.RetryPolicy
+    retry = None
+    # 去重 key, 相同 key 的任务在 DEDUP_TTL 内只会投放一次
+    dedup_key: str | None = None
+    # 是否为重复投放, 重复的任务会指向已存在的任务 id
+    duplicate: bool = False
+    # 投放(延迟任务为到期)时间戳, 用于统计排队等待时间
+    enqueued_at: float | None = None
+    _has_retry: bool | None = None
 
     def __init__(self, data, client, task_id=None, result_queue="", fmt=False, **kwargs):
-        if fmt and setting.OBJ_DATA:
+        if fmt and setting.OBJ_DATA and not codec.is_packed(data):
             data = magic.json_or_eval(data)
         self.data = data
         self.task_id = task_id or str(uuid4())
@@ -35,9 +50,15 @@ class Task:
         for k, v in kwargs.items():
             setattr(self, k, v)
 
-    def encode_data(self, data=None):
-        data = data or self.data
-        if not isinstance(data, (str, bytes)):
+    def encode_data(self, data=empty):
+        # 附带重试策略的任务数据在头部打标记, Agent 据此决定是否读取该任务的重试策略
+        flags = codec.RETRY_FLAG if data is empty and self.retry else 0
+        data = self.data if data is empty else data
+        name = getattr(self.client, "codec", None)
+        compress = getattr(self.client, "compress", None)
+        if name or compress or flags:
+            data = codec.pack(data, name or "raw", compress, getattr(self.client, "compress_threshold", 0), flags)
+        elif not isinstance(data, (str, bytes)):
             data = json.dumps(data, ensure_ascii=False, default=str).encode(setting.DEFAULT_ENCODING)
         elif isinstance(data, str):
             data = data.encode(setting.DEFAULT_ENCODING)
@@ -51,37 +72,44 @@ class Task:
                 return SaltBase64(key=str(encrypt), encoding=setting.DEFAULT_ENCODING).encrypt(data)
         return data
 
-    def decode_data(self, data=None):
-        data = data or self.data
+    def decode_data(self, data=empty):
+        data = self.data if data is empty else data
         if isinstance(data, str):
             data = data.encode(setting.DEFAULT_ENCODING)
         elif isinstance(data, bytes):
             data = data
         else:
             raise TypeError("data 应为 str/bytes")
-        if encrypt := setting.ENCRYPT:
-            if callable(encrypt):
-                data = encrypt(data, mode="decrypt")
-            else:
-                data = SaltBase64(key=str(encrypt), encoding=setting.DEFAULT_ENCODING).decrypt(data)
+        if blob.is_ref(data):
+            raise ValueError("数据为外置存储的引用, 需先通过 client.resolve 读取")
+        data = self.decrypt(data)
+        if codec.is_packed(data):
+            return codec.unpack(data, getattr(self.client, "accept", None))
         if setting.OBJ_DATA:
             data = magic.json_or_eval(data.decode(setting.DEFAULT_ENCODING))
         return data
 
-    async def ensure(self):
-        pubsub = self.client.redis.pubsub()
-        await pubsub.subscribe(self.result_queue)
+    @staticmethod
+    def decrypt(data: bytes) -> bytes:
+        if encrypt := setting.ENCRYPT:
+            if callable(encrypt):
+                return encrypt(data, mode="decrypt")
+            return SaltBase64(key=str(encrypt), encoding=setting.DEFAULT_ENCODING).decrypt(data)
+        return data
 
-        async def get_result():
-            try:
-                async for msg in pubsub.listen():
-                    if msg["type"] == "message":
-                        return msg["data"]
-            finally:
-                await pubsub.unsubscribe(self.result_queue)
-                await pubsub.close()
+    def has_retry(self) -> bool:
+        """投放时是否附带了重试策略, 由 Agent 根据出队的原始数据头部判断"""
+        if self._has_retry is None:
+            data = self.raw if self.raw is not None else self.data
+            if isinstance(data, str):
+                data = data.encode(setting.DEFAULT_ENCODING)
+            if isinstance(data, bytes) and not blob.is_ref(data):
+                data = self.decrypt(data)
+            self._has_retry = bool(codec.get_flags(data) & codec.RETRY_FLAG)
+        return self._has_retry
 
-        self.result = asyncio.ensure_future(get_result())
+    async def ensure(self):
+        self.result = await self.client.router.wait(self.task_id)
 
     async def get_result(self, timeout=None, timeout_back=None):
         if not self.result or self.result.cancelled():
@@ -93,12 +121,12 @@ class Task:
                 await timeout_back()
             elif inspect.isawaitable(timeout_back):
                 await timeout_back
-            else:
+            elif timeout_back:
                 timeout_back()
             raise
         finally:
             self.result.cancel()
-        return result
+        return await self.client.resolve(result)
 
     async def set_status(self, status_id, data=None, expire_time=None):
         await self.client.set_status(status_id, data, expire_time)
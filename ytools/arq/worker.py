@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : worker.py
+@Author  : yintian
+@Date    : 2026/10/18 12:20
+@Software: PyCharm
+@Desc    : 多进程 Agent 启动入口
+
+python -m ytools.arq.worker path.to:worker --processes 4 --concurrency 16 --redis redis://127.0.0.1:6379/0
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from ytools.arq import setting, metrics
+from ytools.arq.client.agent import Agent
+from ytools.arq.client.base import BaseClient
+from ytools.utils import magic
+from ytools.utils.counter import FastWriteCounter
+
+
+class CrashLoopError(RuntimeError):
+    """子进程反复启动失败"""
+
+
+def run_agent(index, target, supervisor_id, options, reports, interval):
+    """子进程入口, 每个子进程运行一个独立事件循环的 Agent"""
+    # 终端 Ctrl+C 会发给整个进程组, 子进程只响应 supervisor 发来的 SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(index, target, supervisor_id, options, reports, interval))
+
+
+async def serve(index, target, supervisor_id, options, reports, interval):
+    agent = Agent(
+        worker=magic.load_object(target) if target else None,
+        worker_id=f"{supervisor_id}:{os.getpid()}:{index}",
+        # 由 supervisor 汇总后统一上报心跳
+        heartbeat_interval=0,
+        handle_signals=(signal.SIGTERM,),
+        **options
+    )
+
+    async def report():
+        while True:
+            reports.put((index, agent.info))
+            await asyncio.sleep(interval)
+
+    asyncio.create_task(report())
+    await agent.run()
+
+
+class Supervisor(BaseClient):
+    """启动并守护 N 个 Agent 子进程, 崩溃后自动重启, 汇总子进程计数写入同一个心跳"""
+
+    def __init__(
+            self,
+            target: str = None,
+            processes: int = None,
+            concurrency: int = None,
+            agent_options: dict = None,
+            metrics_port: int = None,
+            **kwargs
+    ):
+        self.target = target
+        self.processes = processes or os.cpu_count() or 1
+        self.agent_options = {
+            "queue_name": kwargs.get("queue_name"),
+            "redis": kwargs.get("redis"),
+            "max_concurrency": concurrency,
+            **(agent_options or {})
+        }
+        self.ctx = multiprocessing.get_context(setting.PROCESS_START_METHOD)
+        self.reports = self.ctx.Queue()
+        self.children: dict[int, multiprocessing.Process] = {}
+        self.states: dict[int, dict] = {}
+        self.restarts = FastWriteCounter()
+        # 子进程启动时间、连续启动失败次数与计划重启时间, 按 index 记录
+        self.started_at: dict[int, float] = {}
+        self.crashes: dict[int, int] = {}
+        self.restart_at: dict[int, float] = {}
+        # 汇总各子进程指标后在本地端口输出, 子进程自身不监听端口
+        self.metrics_port = metrics_port
+        # 收到 SIGTERM / SIGINT 后不再重启子进程, 通知子进程平滑停止
+        self.stopping = asyncio.Event()
+        super().__init__(**kwargs)
+
+    @property
+    def info(self):
+        totals = {}
+        for state in self.states.values():
+            for k, v in state.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    totals[k] = totals.get(k, 0) + v
+        return {
+            **super().info,
+            **totals,
+            "metrics": self.merge_metrics().to_dict(),
+            "processes": self.processes,
+            "alive": sum(child.is_alive() for child in self.children.values()),
+            "restarts": self.restarts.value,
+            "workers": [state.get("worker_id") for state in self.states.values()],
+        }
+
+    def merge_metrics(self) -> metrics.Metrics:
+        return metrics.Metrics.from_dicts(state.get("metrics") for state in self.states.values())
+
+    def start_child(self, index):
+        child = self.ctx.Process(
+            target=run_agent,
+            args=(index, self.target, self.get_worker_id(), self.agent_options, self.reports, self.heartbeat_interval or setting.HEARTBEAT_INTERVAL),
+            name=f"arq-agent-{index}",
+        )
+        child.start()
+        self.children[index] = child
+        self.started_at[index] = time.monotonic()
+        self.log(f"启动 Agent 子进程 index={index} pid={child.pid}")
+
+    def collect(self):
+        while True:
+            try:
+                index, state = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.states[index] = state
+
+    def check_children(self):
+        now = time.monotonic()
+        for index, child in list(self.children.items()):
+            if child.is_alive():
+                continue
+            if index not in self.restart_at:
+                # 启动后很快退出的累计失败次数, 运行较久后退出则重新计数
+                quick = now - self.started_at.get(index, now) < setting.SUPERVISOR_CRASH_WINDOW
+                self.crashes[index] = self.crashes.get(index, 0) + 1 if quick else 1
+                if self.crashes[index] >= setting.SUPERVISOR_MAX_CRASHES:
+                    raise CrashLoopError(
+                        f"Agent 子进程 index={index} 连续 {self.crashes[index]} 次启动后 {setting.SUPERVISOR_CRASH_WINDOW}s 内退出"
+                        f"(exitcode={child.exitcode}), 不再重启"
+                    )
+                delay = min(setting.SUPERVISOR_MAX_BACKOFF, setting.SUPERVISOR_BACKOFF * 2 ** (self.crashes[index] - 1))
+                self.restart_at[index] = now + delay
+                self.states.pop(index, None)
+                self.log(f"Agent 子进程异常退出 index={index} pid={child.pid} exitcode={child.exitcode}, {delay}s 后重新启动", level="error")
+            if now >= self.restart_at[index]:
+                self.restart_at.pop(index)
+                self.restarts.increment()
+                self.start_child(index)
+
+    def stop(self):
+        for child in self.children.values():
+            child.is_alive() and child.terminate()
+        # 子进程收到 SIGTERM 后平滑停止, 等待其放回未完成的任务, 超时仍未退出的强制结束
+        drain_timeout = self.agent_options.get("drain_timeout") or setting.DRAIN_TIMEOUT
+        deadline = time.monotonic() + drain_timeout + setting.BLOCK_TIMEOUT + setting.SUPERVISOR_INTERVAL
+        for child in self.children.values():
+            child.join(timeout=max(deadline - time.monotonic(), 0))
+            if child.is_alive():
+                self.log(f"Agent 子进程未能在超时前停止, 强制结束 pid={child.pid}", level="error")
+                child.kill()
+        self.children.clear()
+
+    def on_signal(self, signum):
+        if self.stopping.is_set():
+            # 停止期间再次收到信号, 按 quiter 的方式立即退出
+            from ytools.utils.quiter import Quiter
+            Quiter.run(signum, None)
+        self.log("收到退出信号, 通知子进程平滑停止", level="warning")
+        self.stopping.set()
+
+    async def run(self):
+        for index in range(self.processes):
+            self.start_child(index)
+        if self.metrics_port:
+            await metrics.serve(lambda: self.merge_metrics().render(), self.metrics_port)
+            self.log(f"指标地址: http://127.0.0.1:{self.metrics_port}/metrics")
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            with contextlib.suppress(NotImplementedError, RuntimeError, ValueError):
+                loop.add_signal_handler(signum, self.on_signal, signum)
+        try:
+            while not self.stopping.is_set():
+                self.collect()
+                self.check_children()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.stopping.wait(), setting.SUPERVISOR_INTERVAL)
+            await asyncio.to_thread(self.stop)
+            await self.deregister()
+        finally:
+            self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ytools.arq.worker", description="启动多进程 arq Agent")
+    parser.add_argument("target", nargs="?", help="worker 路径, 如 path.to:worker; 为空时执行 {'func': ...} 格式的任务")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="子进程数, 默认为 CPU 核数")
+    parser.add_argument("-c", "--concurrency", type=int, default=None, help="每个子进程的最大并发")
+    parser.add_argument("-q", "--queue", default=None, help="队列名")
+    parser.add_argument("-r", "--redis", default="redis://127.0.0.1:6379/0", help="redis 连接地址")
+    parser.add_argument("--backend", default=None, choices=["zset", "stream"])
+    parser.add_argument("--codec", default=None)
+    parser.add_argument("--accept", default=None, help="额外允许解码的编解码器, 逗号分隔, 如 pickle")
+    parser.add_argument("--compress", default=None)
+    parser.add_argument("--offload-threshold", type=int, default=None, help="数据超过该字节数时写入外置存储")
+    parser.add_argument("--offload-store", default=None, help="外置存储: redis 或目录路径")
+    parser.add_argument("--drain-timeout", type=float, default=None, help="停止时等待执行中任务完成的最长时间(秒)")
+    parser.add_argument("--level", default="info")
+    parser.add_argument("--metrics-port", type=int, default=None, help="在本地端口输出汇总后的 prometheus 指标")
+    args = parser.parse_args(argv)
+    options = {
+        "backend": args.backend,
+        "codec": args.codec,
+        "accept": args.accept and args.accept.split(","),
+        "compress": args.compress,
+        "offload_threshold": args.offload_threshold,
+        "offload_store": args.offload_store,
+        "drain_timeout": args.drain_timeout,
+        "level": args.level,
+    }
+
+    async def run():
+        supervisor = Supervisor(
+            target=args.target,
+            processes=args.processes,
+            concurrency=args.concurrency,
+            agent_options={k: v for k, v in options.items() if v},
+            metrics_port=args.metrics_port,
+            queue_name=args.queue,
+            redis=args.redis,
+            level=args.level,
+        )
+        await supervisor.run()
+
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(run())
+    except CrashLoopError as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == '__main__':
+    main()